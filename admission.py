@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+#
+# Admission checks run by the monitor before a submission is queued.
+#
+# A project lists its checks in its config section, e.g.
+#
+#   admit = archive, members, lines, rate_limit
+#   admit_members = submit.txt group.txt
+#   admit_lines = submit.txt /path/to/answers.txt
+#   admit_groups = /path/to/groups.db
+#   admit_leaderboard = /path/to/leaderboard.db
+#   admit_min_interval = 18000
+#
+# Each check is built from the project's options and raises Rejected to
+# turn a submission away; the monitor then marks it 'rejected' and mails
+# the reason without spending a worker slot on it. Besides the built-in
+# checks below, admit may name any module.Class with the same interface.
+
+import os, time, tarfile, sqlite3, importlib
+
+from extract_cache import (OpenArchive, CloseArchive, CheckMember, MemberPath,
+                           OpenMember, ArchiveError)
+from group_store import GroupStore
+from file_util import IsSQLite
+
+class Rejected(Exception):
+    pass
+
+class Candidate:
+    """A submission being checked: its path, the user who submitted it, and
+    its archive members, read at most once."""
+    def __init__(self, path, username, extract_cache=None):
+        self.path = path
+        self.username = username
+        self.extract_cache = extract_cache
+        self.extract_dir = None
+        self.members = None
+
+    def Members(self):
+        """Returns the set of file members. Raises Rejected if the archive
+        is unreadable or over the extraction limits."""
+        if self.members is not None:
+            return self.members
+        try:
+            if self.extract_cache is not None:
+                self.extract_dir = self.extract_cache.Extract(self.path)
+                self.members = set()
+                for (dirpath, dirnames, filenames) in os.walk(self.extract_dir):
+                    for filename in filenames:
+                        name = os.path.relpath(os.path.join(dirpath, filename),
+                                               self.extract_dir)
+                        if name != '.complete':
+                            self.members.add(name)
+                return self.members
+
+            members = set()
+            (tar, process) = OpenArchive(self.path)
+            try:
+                count = 0
+                total = 0
+                for member in tar:
+                    count += 1
+                    total += member.size
+                    CheckMember(member, count, total)
+                    name = MemberPath(member.name)
+                    if member.isfile() and name is not None:
+                        members.add(name)
+            finally:
+                CloseArchive(tar, process)
+            self.members = members
+            return members
+        except (tarfile.TarError, ArchiveError, IOError, OSError) as err:
+            # OSError: members that cannot be extracted side by side, such
+            # as a file x and a file x/y.
+            raise Rejected("could not read submission: %s" % str(err))
+
+    def Open(self, name):
+        """Returns a file object for member name, or None."""
+        if name not in self.Members():
+            return None
+        if self.extract_dir is not None:
+            return file(os.path.join(self.extract_dir, name), 'rb')
+        return OpenMember(self.path, name)
+
+class ArchiveCheck:
+    """The submission is a readable archive within the extraction limits."""
+    def __init__(self, options):
+        pass
+
+    def Check(self, candidate):
+        candidate.Members()
+
+class MembersCheck:
+    """The archive holds every member listed in admit_members."""
+    def __init__(self, options):
+        self.required = options['admit_members'].split()
+
+    def Check(self, candidate):
+        members = candidate.Members()
+        for name in self.required:
+            if name not in members:
+                raise Rejected("submission does not contain %s!" % name)
+
+def CountLines(fp):
+    """Counts lines the way the scorer reads them, including a last line
+    with no trailing newline."""
+    count = 0
+    last = '\n'
+    while True:
+        block = fp.read(1 << 20)
+        if not block:
+            break
+        count += block.count('\n')
+        last = block[-1]
+    if last != '\n':
+        count += 1
+    return count
+
+class LinesCheck:
+    """A member has as many lines as a reference file, given in admit_lines
+    as '<member> <reference file>'."""
+    def __init__(self, options):
+        (self.member, self.reference) = options['admit_lines'].split()
+        self.reference_mtime = None
+        self.reference_lines = None
+
+    def Check(self, candidate):
+        mtime = os.stat(self.reference).st_mtime
+        if mtime != self.reference_mtime:
+            self.reference_lines = CountLines(file(self.reference, 'rb'))
+            self.reference_mtime = mtime
+
+        fp = candidate.Open(self.member)
+        if fp is None:
+            raise Rejected("submission does not contain %s!" % self.member)
+        lines = CountLines(fp)
+        fp.close()
+        if lines != self.reference_lines:
+            raise Rejected("%s must be %d lines, not %d." % (
+                self.member, self.reference_lines, lines))
+
+class RateLimitCheck:
+    """The submitter's team has a leaderboard entry no newer than
+    admit_min_interval seconds, as update_leaderboard.py enforces."""
+    def __init__(self, options):
+        self.groups_file = options['admit_groups']
+        self.leaderboard_file = options['admit_leaderboard']
+        self.min_interval = float(options['admit_min_interval'])
+
+    def Check(self, candidate):
+        if not os.path.exists(self.groups_file):
+            raise Rejected("username %s has no group" % candidate.username)
+        groups = GroupStore(self.groups_file)
+        groupname = groups.get(candidate.username)
+        groups.Close()
+        if groupname is None:
+            raise Rejected("username %s has no group" % candidate.username)
+
+        # A leaderboard not yet converted from a pickle is left to the
+        # grader.
+        if (not os.path.exists(self.leaderboard_file) or
+            not IsSQLite(self.leaderboard_file)):
+            return
+        conn = sqlite3.connect(self.leaderboard_file, timeout=60)
+        try:
+            row = conn.execute("SELECT submitted FROM leaderboard WHERE name = ?",
+                               (groupname,)).fetchone()
+        except sqlite3.OperationalError:
+            row = None # no leaderboard table yet
+        conn.close()
+        if row is not None and time.time() - row[0] < self.min_interval:
+            raise Rejected("it has only been %d seconds since your last submission. "
+                           "(Submissions allowed every %d seconds.)"
+                           % (int(time.time() - row[0]), self.min_interval))
+
+CHECKS = {'archive': ArchiveCheck, 'members': MembersCheck,
+          'lines': LinesCheck, 'rate_limit': RateLimitCheck}
+
+def MakeCheck(name, options):
+    """Returns the check called name, built-in or module.Class, configured
+    from a project's options."""
+    if name in CHECKS:
+        return CHECKS[name](options)
+    if '.' not in name:
+        raise ValueError("unknown admission check: %s" % name)
+    (module_name, class_name) = name.rsplit('.', 1)
+    return getattr(importlib.import_module(module_name), class_name)(options)
@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+#
+# Synthetic-load benchmarks for the monitor and leaderboard pipelines.
+#
+# For each scale, builds a synthetic target_dir of tarred submissions (each
+# holding group.txt and submit.txt), an answers file and a groups database,
+# then times:
+#
+#   scan_local_cold     GetActionQueue on a fresh monitor (queues everything)
+#   scan_local_warm     GetActionQueue again with nothing changed
+#   scan_sftp           GetActionQueue against a stub SFTP server
+#   update_website      a full UpdateWebsite of every project page
+#   load_database       LoadDatabase of all records
+#   write_database      WriteDatabase
+#   check_groups        one check_groups.py run per submission
+#   check_groups_batch  per submission, registering all in one run
+#   score_compile       compiling answers.txt into the NumPy cache
+#   score_submission    update_leaderboard.py scoring of one submission
+#
+# Only the --script-runs submissions that are scored hold a full-length
+# submit.txt; the others hold a one-line stub, which the scans, website and
+# check_groups.py timings do not read. This keeps the large scale at about
+# 125MB of fixtures instead of 6GB.
+#
+# Results are printed, and with --output appended as one JSON object per
+# line, so runs of different versions can be compared.
+
+import sys, os, time, json, shutil, tempfile, tarfile, socket, threading
+import subprocess, pickle, random, StringIO
+import optparse
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, REPO_DIR)
+
+import monitor_ssh_location
+import update_leaderboard
+
+# (projects, submissions per project, answer lines)
+SCALES = {
+    'small': (2, 50, 1000),
+    'medium': (5, 200, 10000),
+    'large': (10, 1000, 100000),
+}
+
+CONFIG_INI = """
+[Monitor]
+target_dir = {target_dir}
+log_dir = {root}/logs
+username = web_bench
+is_local = {is_local}
+hostname = 127.0.0.1
+port = {port}
+private_key_file = {root}/id_rsa
+private_key_passphrase =
+website_path = {root}/web
+website_header = {repo}/default_header.html
+website_footer = {repo}/default_footer.html
+notify_queue = False
+notify_action = False
+notify_complete = False
+"""
+
+PROJECT_INI = """
+[Project{index}]
+name = project{index}
+action = /bin/true
+size_limit = 100
+time_limit = 10
+"""
+
+class Quiet:
+    """Discards stdout while the monitor is being timed."""
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+
+    def __exit__(self, *args):
+        sys.stdout = self.stdout
+
+def MakeTar(filename, members):
+    tar = tarfile.open(filename, 'w')
+    for (name, data) in members:
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = time.time()
+        tar.addfile(info, StringIO.StringIO(data))
+    tar.close()
+
+def BuildWorkload(root, num_projects, num_submissions, num_answers, pad_bytes,
+                  num_scored):
+    """Creates the synthetic target_dir, answers and groups database under
+    root. The first num_scored submissions of the first project get a full
+    submit.txt. Returns the list of submission paths of the first
+    project."""
+    rng = random.Random(0)
+    target_dir = os.path.join(root, 'submit')
+    os.makedirs(os.path.join(root, 'logs'))
+    os.makedirs(os.path.join(root, 'web'))
+    os.makedirs(os.path.join(root, 'db'))
+
+    answers = file(os.path.join(root, 'answers.txt'), 'w')
+    for i in range(num_answers):
+        answers.write("%d %d\n" % (rng.randint(1, 5), rng.random() < 0.3))
+    answers.close()
+    submit_txt = ''.join(["%.3f\n" % rng.uniform(0, 6)
+                          for i in range(num_answers)])
+    padding = 'x' * pad_bytes
+
+    groups = {'users': {}, 'groups': {}}
+    first_project = []
+    for p in range(num_projects):
+        project_dir = os.path.join(target_dir, 'project%d' % p)
+        os.makedirs(project_dir)
+        for s in range(num_submissions):
+            user = 'user%d' % s
+            group = 'team%d' % (s // 3)
+            path = os.path.join(project_dir, user)
+            if p == 0 and s < num_scored:
+                submission_txt = submit_txt
+            else:
+                submission_txt = submit_txt[:submit_txt.index('\n') + 1]
+            MakeTar(path, [('group.txt', group + '\n'),
+                           ('submit.txt', submission_txt),
+                           ('padding.bin', padding)])
+            if p == 0:
+                first_project.append(path)
+                groups['users'][user] = group
+                groups['groups'].setdefault(group, set()).add(user)
+    pickle.dump(groups, file(os.path.join(root, 'groups.db'), 'w'))
+    return first_project
+
+def WriteConfig(root, num_projects, is_local, port=0):
+    filename = os.path.join(root, 'bench-%s.ini' % ('local' if is_local else 'sftp'))
+    f = file(filename, 'w')
+    f.write(CONFIG_INI.format(root=root, repo=REPO_DIR, port=port,
+                              target_dir=os.path.join(root, 'submit'),
+                              is_local=str(is_local).lower()))
+    for p in range(num_projects):
+        f.write(PROJECT_INI.format(index=p))
+    f.close()
+    return filename
+
+def NewMonitor(ini):
+    with Quiet():
+        monitor = monitor_ssh_location.MonitorSSHLocation(
+            monitor_ssh_location.MonitorConfig(ini))
+        monitor.OpenDatabase()
+    return monitor
+
+def Timed(func):
+    start = time.time()
+    with Quiet():
+        func()
+    return time.time() - start
+
+def StartStubServer(root):
+    import paramiko
+    import benchmark_sftp
+    host_key = paramiko.RSAKey.generate(2048)
+    paramiko.RSAKey.generate(2048).write_private_key_file(
+        os.path.join(root, 'id_rsa'))
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(16)
+    server = threading.Thread(target=benchmark_sftp.ServeForever,
+                              args=(listener, host_key))
+    server.daemon = True
+    server.start()
+    return listener.getsockname()[1]
+
+def RunScale(name, options):
+    (num_projects, num_submissions, num_answers) = SCALES[name]
+    root = tempfile.mkdtemp(prefix='submit-bench-')
+    cwd = os.getcwd()
+    results = {}
+    try:
+        submissions = BuildWorkload(root, num_projects, num_submissions,
+                                    num_answers, options.pad_bytes,
+                                    options.script_runs)
+        os.chdir(root) # the monitor keeps its database in ./db
+
+        ini = WriteConfig(root, num_projects, True)
+        monitor = NewMonitor(ini)
+        results['scan_local_cold'] = Timed(monitor.GetActionQueue)
+        results['scan_local_warm'] = Timed(monitor.GetActionQueue)
+        for project in monitor.config.projects:
+            monitor.renderer.MarkDirty(project.name)
+        results['update_website'] = Timed(monitor.UpdateWebsite)
+        results['write_database'] = Timed(monitor.WriteDatabase)
+        monitor.notifier.Close()
+
+        monitor = NewMonitor(ini)
+        results['load_database'] = Timed(monitor.LoadDatabase)
+        monitor.notifier.Close()
+
+        if not options.no_sftp:
+            port = StartStubServer(root)
+            shutil.rmtree(os.path.join(root, 'db'))
+            os.makedirs(os.path.join(root, 'db'))
+            monitor = NewMonitor(WriteConfig(root, num_projects, False, port))
+            monitor.connection = monitor_ssh_location.SFTPConnection(monitor.config)
+            with Quiet():
+                monitor.connection.Connect()
+            results['scan_sftp'] = Timed(monitor.GetActionQueue)
+            monitor.connection.Close()
+            monitor.notifier.Close()
+
+        sample = submissions[:options.script_runs]
+        start = time.time()
+        for path in sample:
+            subprocess.check_call([sys.executable,
+                                   os.path.join(REPO_DIR, 'check_groups.py'),
+                                   os.path.join(root, 'groups-run.db'), path],
+                                  stdout=open(os.devnull, 'w'))
+        results['check_groups'] = (time.time() - start) / len(sample)
+        start = time.time()
+        subprocess.check_call([sys.executable,
+                               os.path.join(REPO_DIR, 'check_groups.py'),
+                               os.path.join(root, 'groups-batch.db')] + sample,
+                              stdout=open(os.devnull, 'w'))
+        results['check_groups_batch'] = (time.time() - start) / len(sample)
+
+        answers_file = os.path.join(root, 'answers.txt')
+        results['score_compile'] = Timed(
+            lambda: update_leaderboard.Answers(answers_file))
+        answers = update_leaderboard.Answers(answers_file)
+        start = time.time()
+        for path in sample:
+            member = update_leaderboard.OpenMember(path, 'submit.txt')
+            answers.Score(member)
+        results['score_submission'] = (time.time() - start) / len(sample)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(root)
+
+    return {'scale': name, 'projects': num_projects,
+            'submissions': num_submissions, 'answer_lines': num_answers,
+            'monitor_version': monitor_ssh_location.VERSION,
+            'leaderboard_version': update_leaderboard.VERSION,
+            'timestamp': int(time.time()), 'seconds': results}
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage="usage: %prog [options]")
+    parser.add_option('--scales', default='small,medium',
+                      help='comma separated scales: ' + ', '.join(sorted(SCALES)))
+    parser.add_option('--pad-bytes', type='int', default=1000,
+                      help='padding member size in each submission tar')
+    parser.add_option('--script-runs', type='int', default=10,
+                      help='submissions to run check_groups.py and scoring on')
+    parser.add_option('--no-sftp', action='store_true',
+                      help='skip the stub SFTP scan (needs paramiko)')
+    parser.add_option('--output', help='append JSON results to this file')
+    (options, args) = parser.parse_args()
+
+    for name in options.scales.split(','):
+        result = RunScale(name, options)
+        print "%s (%d projects x %d submissions, %d answer lines):" % (
+            name, result['projects'], result['submissions'],
+            result['answer_lines'])
+        for (key, secs) in sorted(result['seconds'].iteritems()):
+            print "  %-18s %10.4f secs" % (key, secs)
+        sys.stdout.flush()
+        if options.output:
+            f = file(options.output, 'a')
+            f.write(json.dumps(result, sort_keys=True) + '\n')
+            f.close()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+#
+# Benchmarks remote scanning in GetActionQueue against a stub SFTP
+# server running on localhost. For an increasing number of projects it
+# compares a fresh connection listing one directory at a time (the old
+# behaviour) with a persistent SFTPConnection listing in parallel.
+
+import sys, os, time, socket, shutil, tempfile, threading
+import optparse
+import paramiko
+
+from monitor_ssh_location import SFTPConnection
+
+class StubServer(paramiko.ServerInterface):
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+class StubSFTPInterface(paramiko.SFTPServerInterface):
+    """Serves a local directory read-only, sleeping `latency` seconds per
+    directory listing to imitate a slow or distant file server."""
+    latency = 0
+
+    def list_folder(self, path):
+        time.sleep(self.latency)
+        try:
+            attrs = []
+            for filename in os.listdir(path):
+                attr = paramiko.SFTPAttributes.from_stat(
+                    os.stat(os.path.join(path, filename)))
+                attr.filename = filename
+                attrs.append(attr)
+            return attrs
+        except OSError as err:
+            return paramiko.SFTPServer.convert_errno(err.errno)
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(path))
+        except OSError as err:
+            return paramiko.SFTPServer.convert_errno(err.errno)
+
+    lstat = stat
+
+def ServeForever(listener, host_key):
+    while True:
+        conn, addr = listener.accept()
+        transport = paramiko.Transport(conn)
+        transport.add_server_key(host_key)
+        transport.set_subsystem_handler('sftp', paramiko.SFTPServer,
+                                        StubSFTPInterface)
+        transport.start_server(server=StubServer())
+
+class BenchmarkConfig:
+    def __init__(self, port, key_file, channels):
+        self.hostname = '127.0.0.1'
+        self.port = port
+        self.username = 'bench'
+        self.private_key_file = key_file
+        self.private_key_passphrase = None
+        self.sftp_channels = channels
+
+def MakeTargetDir(root, num_projects, num_submissions):
+    names = []
+    for i in range(num_projects):
+        name = 'project%d' % i
+        os.mkdir(os.path.join(root, name))
+        for j in range(num_submissions):
+            f = file(os.path.join(root, name, 'user%d' % j), 'w')
+            f.write('x')
+            f.close()
+        names.append(name)
+    return names
+
+def ScanFresh(config, target_dir, names):
+    client = paramiko.SSHClient()
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    client.connect(hostname=config.hostname, port=config.port,
+                   username=config.username,
+                   pkey=paramiko.RSAKey.from_private_key_file(
+                       config.private_key_file))
+    sftp = client.open_sftp()
+    dirlist = sftp.listdir(target_dir)
+    for name in set(names).intersection(set(dirlist)):
+        sftp.listdir_attr(target_dir + '/' + name)
+    client.close()
+
+def TimeIt(func, repeat):
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return min(times)
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage="usage: %prog [options]")
+    parser.add_option('--projects', default='1,2,4,8,16',
+                      help='comma separated project counts to test')
+    parser.add_option('--submissions', type='int', default=200,
+                      help='submissions per project')
+    parser.add_option('--channels', type='int', default=4,
+                      help='SFTP channels for the pooled scan')
+    parser.add_option('--latency', type='float', default=0.02,
+                      help='simulated seconds per directory listing')
+    parser.add_option('--repeat', type='int', default=3)
+    (options, args) = parser.parse_args()
+
+    StubSFTPInterface.latency = options.latency
+    workdir = tempfile.mkdtemp()
+    try:
+        host_key = paramiko.RSAKey.generate(2048)
+        client_key = paramiko.RSAKey.generate(2048)
+        key_file = os.path.join(workdir, 'id_rsa')
+        client_key.write_private_key_file(key_file)
+
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(16)
+        server = threading.Thread(target=ServeForever,
+                                  args=(listener, host_key))
+        server.daemon = True
+        server.start()
+        config = BenchmarkConfig(listener.getsockname()[1], key_file,
+                                 options.channels)
+
+        print "projects,submissions,fresh_sequential_secs,pooled_parallel_secs"
+        for num_projects in [int(n) for n in options.projects.split(',')]:
+            target_dir = os.path.join(workdir, 'submit%d' % num_projects)
+            os.mkdir(target_dir)
+            names = MakeTargetDir(target_dir, num_projects, options.submissions)
+
+            fresh = TimeIt(lambda: ScanFresh(config, target_dir, names),
+                           options.repeat)
+            connection = SFTPConnection(config)
+            connection.ListProjects(target_dir, names) # warm up
+            pooled = TimeIt(lambda: connection.ListProjects(target_dir, names),
+                            options.repeat)
+            connection.Close()
+            print "%d,%d,%.4f,%.4f" % (num_projects, options.submissions,
+                                       fresh, pooled)
+            sys.stdout.flush()
+    finally:
+        shutil.rmtree(workdir)
@@ -1,9 +1,4 @@
 #!/bin/bash
+# usage: check_failed_logs.sh <project> <status> <stdout|stderr>
 
-project=$1
-failed=`grep $2 db/cis520.$1 | awk -F ',' '{print $1}'`
-echo $failed
-for f in $failed
-do
-    cat ~/project_logs/$3.$1.$f
-done
+python log_store.py db/cis520.sqlite db/cis520.logs failed $1 "%$2%" $3
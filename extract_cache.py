@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+#
+# Content-addressed cache of extracted submission archives.
+#
+# The monitor extracts each tar (optionally gzip/bzip2 or .Z compressed)
+# submission once into <cache_dir>/<sha1 of archive>/ when it queues it.
+# Graders, check_groups.py and update_leaderboard.py then read members from
+# there instead of decompressing the archive again. The cache directory is
+# passed to actions in the SUBMISSION_CACHE environment variable.
+#
+# Each extraction's .complete marker holds its size in bytes and is touched
+# whenever it is looked up. Given max_bytes, the monitor removes the least
+# recently used extractions after each new one to keep the cache under that
+# size; readers that then miss the cache stream the archive instead.
+
+import sys, os, shutil, hashlib, tarfile, subprocess, tempfile
+
+CACHE_ENV = 'SUBMISSION_CACHE'
+
+MAX_MEMBERS = 1000
+MAX_MEMBER_SIZE = 50 * 1000000
+MAX_TOTAL_SIZE = 200 * 1000000
+
+COMPRESS_MAGIC = '\x1f\x9d'
+
+class ArchiveError(Exception):
+    pass
+
+def HashFile(filename):
+    sha1 = hashlib.sha1()
+    fp = file(filename, 'rb')
+    while True:
+        block = fp.read(1 << 20)
+        if not block:
+            break
+        sha1.update(block)
+    fp.close()
+    return sha1.hexdigest()
+
+def OpenArchive(filename):
+    """Opens filename as a tar stream. Returns (tarfile, process), where
+    process is the decompressor for .Z archives or None."""
+    fp = file(filename, 'rb')
+    if fp.read(2) == COMPRESS_MAGIC:
+        fp.close()
+        # tarfile cannot read compress(1) archives, but gzip can.
+        process = subprocess.Popen(['gzip', '-dc', filename],
+                                   stdout=subprocess.PIPE)
+        return (tarfile.open(fileobj=process.stdout, mode='r|'), process)
+    fp.seek(0)
+    return (tarfile.open(fileobj=fp, mode='r|*'), None)
+
+def CloseArchive(tar, process):
+    tar.close()
+    if process is not None:
+        process.stdout.close()
+        process.wait()
+
+def CheckMember(member, count, total):
+    if count > MAX_MEMBERS:
+        raise ArchiveError("archive has more than %d members" % MAX_MEMBERS)
+    if member.size > MAX_MEMBER_SIZE:
+        raise ArchiveError("member %s is larger than %d bytes"
+                           % (member.name, MAX_MEMBER_SIZE))
+    if total > MAX_TOTAL_SIZE:
+        raise ArchiveError("archive is larger than %d bytes" % MAX_TOTAL_SIZE)
+
+def MemberPath(name):
+    """Returns the normalized relative path of a member, or None if it
+    would land outside the extraction directory."""
+    path = os.path.normpath(name)
+    if os.path.isabs(path) or path == '..' or path.startswith('../'):
+        return None
+    return path
+
+def EntrySize(path):
+    """Returns the bytes extracted into the cache directory path."""
+    size = file(os.path.join(path, '.complete')).read().strip()
+    if size:
+        return int(size)
+    # Extracted before sizes were recorded.
+    total = 0
+    for (dirpath, dirnames, filenames) in os.walk(path):
+        for filename in filenames:
+            total += os.path.getsize(os.path.join(dirpath, filename))
+    return total
+
+class ExtractCache:
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        if not os.path.exists(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                pass # created by a concurrent process
+
+    def Lookup(self, key):
+        """Returns the extraction directory for key if it is complete."""
+        path = os.path.join(self.cache_dir, key)
+        complete = os.path.join(path, '.complete')
+        if not os.path.exists(complete):
+            return None
+        try:
+            os.utime(complete, None)
+        except OSError:
+            pass # evicted meanwhile, or a read-only cache
+        return path
+
+    def Extract(self, archive):
+        """Extracts archive into the cache unless it is already there and
+        returns the directory holding its members."""
+        key = HashFile(archive)
+        path = self.Lookup(key)
+        if path is not None:
+            return path
+
+        tmp_path = tempfile.mkdtemp(prefix='.' + key, dir=self.cache_dir)
+        try:
+            (tar, process) = OpenArchive(archive)
+            try:
+                count = 0
+                total = 0
+                extracted = 0
+                for member in tar:
+                    count += 1
+                    total += member.size
+                    CheckMember(member, count, total)
+                    name = MemberPath(member.name)
+                    if not member.isfile() or name is None:
+                        continue
+                    target = os.path.join(tmp_path, name)
+                    try:
+                        if not os.path.isdir(os.path.dirname(target)):
+                            os.makedirs(os.path.dirname(target))
+                        dst = file(target, 'wb')
+                    except (IOError, OSError) as err:
+                        # e.g. members x and x/y
+                        raise ArchiveError("cannot extract member %s: %s" % (
+                                member.name, err.strerror))
+                    src = tar.extractfile(member)
+                    shutil.copyfileobj(src, dst)
+                    dst.close()
+                    extracted += member.size
+            finally:
+                CloseArchive(tar, process)
+            complete = file(os.path.join(tmp_path, '.complete'), 'w')
+            complete.write(str(extracted))
+            complete.close()
+        except tarfile.TarError as err:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise ArchiveError(str(err))
+        except:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+
+        path = os.path.join(self.cache_dir, key)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # Lost a race with another process extracting the same archive.
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            if self.Lookup(key) is None:
+                raise
+            return path
+        if self.max_bytes is not None:
+            self.Evict(keep=key)
+        return path
+
+    def Evict(self, keep=None):
+        """Removes the least recently used extractions, other than keep,
+        until the cache holds at most max_bytes."""
+        entries = []
+        total = 0
+        for key in os.listdir(self.cache_dir):
+            if key.startswith('.'):
+                continue # being extracted or removed
+            path = os.path.join(self.cache_dir, key)
+            try:
+                used = os.stat(os.path.join(path, '.complete')).st_mtime
+                size = EntrySize(path)
+            except (IOError, OSError, ValueError):
+                continue
+            entries.append((used, key, size))
+            total += size
+
+        entries.sort()
+        for (used, key, size) in entries:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            # Renamed first so that readers never see a partial entry.
+            doomed = os.path.join(self.cache_dir,
+                                  '.%s.evicted.%d' % (key, os.getpid()))
+            try:
+                os.rename(os.path.join(self.cache_dir, key), doomed)
+            except OSError:
+                continue # removed by another process
+            shutil.rmtree(doomed, ignore_errors=True)
+            total -= size
+
+def OpenMember(archive, member_name, cache_dir=None):
+    """Returns a file object for member_name of archive, or None if the
+    archive has no such member.
+
+    If cache_dir (by default $SUBMISSION_CACHE) holds the extracted archive
+    the member is read from there; otherwise the archive is streamed only up
+    to that member.
+    """
+    if cache_dir is None:
+        cache_dir = os.environ.get(CACHE_ENV)
+    if cache_dir is not None:
+        path = ExtractCache(cache_dir).Lookup(HashFile(archive))
+        if path is not None:
+            member_path = os.path.join(path, member_name)
+            if os.path.isfile(member_path):
+                return file(member_path, 'rb')
+            return None
+
+    (tar, process) = OpenArchive(archive)
+    try:
+        count = 0
+        total = 0
+        for member in tar:
+            count += 1
+            total += member.size
+            CheckMember(member, count, total)
+            if member.isfile() and MemberPath(member.name) == member_name:
+                # Stream members can only be read before advancing, so
+                # copy this one out.
+                return CopyToSpool(tar.extractfile(member))
+    finally:
+        CloseArchive(tar, process)
+    return None
+
+def CopyToSpool(src):
+    spool = tempfile.SpooledTemporaryFile(max_size=1 << 20)
+    shutil.copyfileobj(src, spool)
+    spool.seek(0)
+    return spool
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print "usage: %s <cache_dir> <archive>" % sys.argv[0]
+        print "Extracts archive into the cache and prints its directory."
+        sys.exit(1)
+    try:
+        print ExtractCache(sys.argv[1]).Extract(sys.argv[2])
+    except ArchiveError as err:
+        sys.stderr.write("error: %s\n" % str(err))
+        sys.exit(1)
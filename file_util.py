@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+#
+# File helpers shared by the monitor and the grading scripts.
+#
+# The leaderboard and groups databases are SQLite files on shared, often
+# NFS, home directories, converted in place from the pickles that older
+# versions wrote. Website pages and feeds are replaced atomically, since
+# they are read while the monitor and update_leaderboard.py rewrite them.
+
+import os, sqlite3, fcntl, pickle, shutil
+
+def WriteFileAtomic(filename, text):
+    """Replaces filename with text so readers never see a partial file."""
+    tmp_filename = "%s.tmp.%d" % (filename, os.getpid())
+    fp = file(tmp_filename, "w")
+    fp.write(text)
+    fp.close()
+    os.rename(tmp_filename, filename)
+
+def IsSQLite(filename):
+    # A database just created by another process is empty until its schema
+    # is written.
+    header = file(filename, 'rb').read(16)
+    return header == '' or header == 'SQLite format 3\000'
+
+def ConnectShared(dbfile, schema):
+    """Opens an SQLite database on shared storage in autocommit mode and
+    creates its schema."""
+    conn = sqlite3.connect(dbfile, timeout=60, isolation_level=None)
+    # The default rollback journal: WAL needs shared memory, which does
+    # not work for files on NFS home directories.
+    conn.execute("PRAGMA journal_mode=DELETE")
+    conn.executescript(schema)
+    return conn
+
+def ConvertPickle(dbfile, schema, load):
+    """Converts the pickled database dbfile to SQLite in place and keeps
+    the pickle as <dbfile>.pickle. load(conn, old_db) writes the unpickled
+    records to conn in a transaction. Concurrent conversions are serialized
+    on <dbfile>.lock."""
+    lock = file(dbfile + '.lock', 'w')
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    try:
+        # Another process may have converted it while we waited.
+        if IsSQLite(dbfile):
+            return
+        old_db = pickle.load(file(dbfile, 'r'))
+        tmp_dbfile = dbfile + '.tmp.%d' % os.getpid()
+        conn = ConnectShared(tmp_dbfile, schema)
+        conn.execute("BEGIN IMMEDIATE")
+        load(conn, old_db)
+        conn.execute("COMMIT")
+        conn.close()
+        # Keep the pickle, then swap in the database in one step so that
+        # dbfile always exists for concurrent openers.
+        if os.path.exists(dbfile + '.pickle'):
+            os.remove(dbfile + '.pickle')
+        try:
+            os.link(dbfile, dbfile + '.pickle')
+        except OSError:
+            shutil.copyfile(dbfile, dbfile + '.pickle')
+        os.rename(tmp_dbfile, dbfile)
+    finally:
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        lock.close()
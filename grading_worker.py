@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+#
+# Grading worker for a monitor configured with a work_queue.
+#
+# Reads the monitor's config.ini, claims jobs from the shared work queue
+# and runs them with the same timeout handling and resource limits as the
+# monitor itself. Any number of workers may run on any host that mounts
+# the work queue, log_dir and target_dir at the same paths as the monitor.
+#
+# usage: grading_worker.py <config.ini> [slots] [worker_id]
+
+import sys, os, time, socket, Queue
+
+from monitor_ssh_location import MonitorConfig, ActionSlot
+from work_queue import WorkQueue
+from extract_cache import CACHE_ENV
+
+class GradingWorker:
+    def __init__(self, config, slots, worker_id):
+        self.config = config
+        self.slots = slots
+        self.worker_id = worker_id
+        self.work_queue = WorkQueue(config.work_queue, config.lease_time)
+        # Renew well before the lease expires.
+        self.renew_interval = config.lease_time / 4.0
+        self.done_queue = Queue.Queue()
+        # ActionSlot -> (job, lease file)
+        self.running = {}
+        if config.extract_cache is not None:
+            os.environ[CACHE_ENV] = os.path.abspath(config.extract_cache)
+
+    def StartJob(self, job, lease):
+        print "%s: running job %s: %s" % (self.worker_id, job['id'],
+                                          ' '.join(job['args']))
+        stdout = file(job['stdout'], 'w')
+        stderr = file(job['stderr'], 'w')
+        slot = ActionSlot(job, job['args'], stdout, stderr, self.done_queue)
+        slot.lost = False
+        self.running[slot] = (job, lease)
+        slot.start()
+
+    def FinishJob(self, slot):
+        (job, lease) = self.running.pop(slot)
+        if slot.lost:
+            print "%s: lost the lease on job %s" % (self.worker_id, job['id'])
+            return
+        error = None
+        if slot.error is not None:
+            error = str(slot.error)
+        print "%s: job %s returned %s (%.2f secs)" % (
+            self.worker_id, job['id'], slot.returncode, slot.elapsed)
+        self.work_queue.Complete(job, lease, {
+                'worker': self.worker_id, 'killed': slot.killed,
+                'returncode': slot.returncode, 'error': error,
+                'elapsed': slot.elapsed, 'cpu_time': slot.cpu_time,
+                'max_rss': slot.max_rss})
+
+    def RenewLeases(self):
+        for (slot, (job, lease)) in self.running.items():
+            if slot.lost or self.work_queue.Renew(lease):
+                continue
+            # The scanner requeued the job, so another worker owns it now.
+            slot.lost = True
+            with slot.lock:
+                if not slot.reaped and slot.process is not None:
+                    slot.KillGroup()
+
+    def Run(self):
+        print "%s: grading from %s with %d slots" % (
+            self.worker_id, self.config.work_queue, self.slots)
+        last_renew = time.time()
+        while True:
+            while len(self.running) < self.slots:
+                (job, lease) = self.work_queue.Claim(self.worker_id)
+                if job is None:
+                    break
+                self.StartJob(job, lease)
+
+            # Wait for a slot to finish, but never past the next renewal;
+            # poll the queue for new jobs only while a slot is free.
+            timeout = self.renew_interval
+            if len(self.running) < self.slots:
+                timeout = min(timeout, self.config.poll_min)
+            try:
+                self.FinishJob(self.done_queue.get(True, timeout))
+            except Queue.Empty:
+                pass
+
+            if time.time() - last_renew >= self.renew_interval:
+                self.RenewLeases()
+                last_renew = time.time()
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print "usage: %s <config.ini> [slots] [worker_id]" % sys.argv[0]
+        sys.exit(1)
+
+    config = MonitorConfig(sys.argv[1])
+    if config.work_queue is None:
+        print "error: %s does not set work_queue" % sys.argv[1]
+        sys.exit(1)
+    slots = 1
+    if len(sys.argv) > 2:
+        slots = int(sys.argv[2])
+    worker_id = "%s.%d" % (socket.gethostname(), os.getpid())
+    if len(sys.argv) > 3:
+        worker_id = sys.argv[3]
+
+    try:
+        GradingWorker(config, slots, worker_id).Run()
+    except KeyboardInterrupt:
+        pass
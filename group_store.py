@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+#
+# SQLite storage for project group memberships.
+#
+# Each user belongs to at most one group. Registering a user is a single-row
+# upsert inside an IMMEDIATE transaction, so concurrent check_groups.py runs
+# are serialized instead of overwriting each other, and lookups of one user
+# or one group read only the rows they need. A groups database pickled by
+# older versions is converted in place the first time it is opened (the
+# pickle is kept as <dbfile>.pickle).
+
+import os
+
+from file_util import IsSQLite, ConnectShared, ConvertPickle
+
+GROUPS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS memberships (
+  user TEXT PRIMARY KEY,
+  groupname TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS memberships_group ON memberships (groupname);
+"""
+
+class GroupError(Exception):
+    pass
+
+class GroupStore:
+    def __init__(self, dbfile):
+        self.dbfile = dbfile
+        if os.path.exists(dbfile) and not IsSQLite(dbfile):
+            ConvertPickle(dbfile, GROUPS_SCHEMA, self.LoadPickle)
+        self.conn = ConnectShared(dbfile, GROUPS_SCHEMA)
+
+    def LoadPickle(self, conn, old_db):
+        conn.executemany(
+            "INSERT INTO memberships (user, groupname) VALUES (?, ?)",
+            old_db['users'].items())
+
+    def get(self, user):
+        """Returns the group of user, or None."""
+        row = self.conn.execute(
+            "SELECT groupname FROM memberships WHERE user = ?",
+            (user,)).fetchone()
+        if row is None:
+            return None
+        return str(row[0])
+
+    def members(self, groupname):
+        """Returns the set of users in groupname, or None if it is empty."""
+        users = set([str(row[0]) for row in self.conn.execute(
+            "SELECT user FROM memberships WHERE groupname = ?", (groupname,))])
+        return users or None
+
+    def Register(self, user, groupname):
+        """Moves user into groupname. Returns the group's members."""
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            if self.conn.execute(
+                    "SELECT 1 FROM memberships WHERE user = ?",
+                    (groupname,)).fetchone() is not None:
+                raise GroupError("invalid groupname %s; this belongs to a username"
+                                 % groupname)
+            self.conn.execute(
+                "INSERT OR REPLACE INTO memberships (user, groupname) "
+                "VALUES (?, ?)", (user, groupname))
+            self.conn.execute("COMMIT")
+        except:
+            self.conn.execute("ROLLBACK")
+            raise
+        return self.members(groupname)
+
+    def Close(self):
+        self.conn.close()
@@ -0,0 +1,157 @@
+/*
+  Client side of a submission monitor project page.
+
+  The monitor writes, next to <project>.html:
+    <project>.json          index: seq, page_size, total, counts and a
+                            tag per page of submissions
+    <project>.<n>.json      page n: [name, size, submitted, status, updated]
+    <project>.changes.json  seq and the latest changes: [seq, name, ...]
+
+  The page is served with its first page of rows. This script polls the
+  small index and fetches a page only when its tag changes, so a refresh
+  costs a few KB no matter how many submissions the project has. Rows are
+  swapped inside the table sorttable.js already manages, so sorting by a
+  column header still works on the page shown.
+*/
+
+var status_page = {
+  poll_interval: 30000,
+  changes_shown: 10,
+
+  // pages is the number of pages and tag that of page 0, which the HTML
+  // was rendered with.
+  init: function(project, pages, tag) {
+    status_page.project = project;
+    status_page.index = {seq: null, pages: [], total: 0, page_size: 0};
+    status_page.page = 0;
+    status_page.page_tag = tag;
+    status_page.num_pages = pages;
+    status_page.table = document.getElementById('submissions');
+    status_page.ShowPage(status_page.HashPage());
+    window.onhashchange = function() {
+      status_page.ShowPage(status_page.HashPage());
+    };
+    setInterval(status_page.Poll, status_page.poll_interval);
+    status_page.Poll();
+  },
+
+  HashPage: function() {
+    var match = /^#page=(\d+)$/.exec(window.location.hash);
+    return match ? parseInt(match[1], 10) : 0;
+  },
+
+  Fetch: function(suffix, callback) {
+    var request = new XMLHttpRequest();
+    // The shards change in place, so do not let a cache answer for them.
+    request.open('GET', status_page.project + suffix + '?' +
+                 new Date().getTime(), true);
+    request.onreadystatechange = function() {
+      if (request.readyState == 4 && request.status == 200) {
+        callback(JSON.parse(request.responseText));
+      }
+    };
+    request.send(null);
+  },
+
+  Poll: function() {
+    status_page.Fetch('.json', function(index) {
+      if (index.seq === status_page.index.seq) return;
+      var first = status_page.index.seq === null;
+      status_page.index = index;
+      status_page.num_pages = index.pages.length;
+      status_page.ShowPage(status_page.page);
+      if (!first) status_page.ShowChanges();
+    });
+  },
+
+  ShowPage: function(page) {
+    page = Math.max(0, Math.min(page, status_page.num_pages - 1));
+    var tag = status_page.index.pages[page];
+    if (page != status_page.page || (tag && tag != status_page.page_tag)) {
+      status_page.page = page;
+      status_page.Fetch('.' + page + '.json', function(rows) {
+        if (page != status_page.page) return;
+        status_page.page_tag = tag;
+        status_page.RenderRows(rows);
+      });
+    }
+    status_page.RenderPager();
+  },
+
+  FormatTime: function(secs) {
+    var d = new Date(secs * 1000);
+    function pad(n) { return (n < 10 ? '0' : '') + n; }
+    return d.getFullYear() + '-' + pad(d.getMonth() + 1) + '-' +
+      pad(d.getDate()) + ' ' + pad(d.getHours()) + ':' +
+      pad(d.getMinutes()) + ':' + pad(d.getSeconds());
+  },
+
+  MakeRow: function(row) {
+    var tr = document.createElement('tr');
+    var cells = [row[0], row[1] + ' MB', status_page.FormatTime(row[2]),
+                 row[3] + ' (' + status_page.FormatTime(row[4]) + ')'];
+    for (var i = 0; i < cells.length; i++) {
+      var td = document.createElement('td');
+      td.appendChild(document.createTextNode(cells[i]));
+      tr.appendChild(td);
+    }
+    return tr;
+  },
+
+  RenderRows: function(rows) {
+    var tbody = status_page.table.tBodies[0];
+    while (tbody.rows.length > 0) tbody.removeChild(tbody.rows[0]);
+    for (var i = 0; i < rows.length; i++) {
+      tbody.appendChild(status_page.MakeRow(rows[i]));
+    }
+    // The new rows are in name order; clear sorttable's column marker.
+    var head = status_page.table.tHead;
+    if (!head) return;
+    var cells = head.rows[0].cells;
+    for (var i = 0; i < cells.length; i++) {
+      cells[i].className = cells[i].className.replace(/\s*sorttable_sorted(_reverse)?/, '');
+    }
+    var ids = ['sorttable_sortfwdind', 'sorttable_sortrevind'];
+    for (var i = 0; i < ids.length; i++) {
+      var ind = document.getElementById(ids[i]);
+      if (ind) ind.parentNode.removeChild(ind);
+    }
+  },
+
+  RenderPager: function() {
+    var pager = document.getElementById('pager');
+    var html = [];
+    if (status_page.num_pages > 1) {
+      html.push('Page: ');
+      for (var i = 0; i < status_page.num_pages; i++) {
+        html.push(i == status_page.page ? '<b>' + (i + 1) + '</b>' :
+                  '<a href="#page=' + i + '">' + (i + 1) + '</a>');
+      }
+    }
+    if (status_page.index.total) {
+      html.push('(' + status_page.index.total + ' submissions)');
+    }
+    pager.innerHTML = html.join(' ');
+  },
+
+  ShowChanges: function() {
+    status_page.Fetch('.changes.json', function(changes) {
+      var div = document.getElementById('changes');
+      div.innerHTML = '';
+      var rows = changes.rows.slice(-status_page.changes_shown).reverse();
+      if (rows.length == 0) return;
+      var h = document.createElement('h3');
+      h.appendChild(document.createTextNode('Recent changes'));
+      div.appendChild(h);
+      var ul = document.createElement('ul');
+      for (var i = 0; i < rows.length; i++) {
+        var li = document.createElement('li');
+        li.appendChild(document.createTextNode(
+          status_page.FormatTime(rows[i][5]) + ': ' + rows[i][1] + ' ' +
+          rows[i][4]));
+        ul.appendChild(li);
+      }
+      div.appendChild(ul);
+    });
+  }
+};
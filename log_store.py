@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+#
+# Bounded capture and compressed storage of action logs.
+#
+# While an action runs, LogCapture reads its stdout/stderr from a pipe and
+# writes at most log_limit bytes of each to the flat log file: the first
+# half verbatim and, if the action writes more, a marker and the last half.
+# Memory use is bounded by the tail being kept.
+#
+# When the action finishes, the monitor appends the zlib-compressed log to
+# an append-only data file (./db/<username>.logs) and removes the flat file.
+# The offset of each log is indexed by its flat path in the submission
+# database's logs table, so failed-run logs are found with one query.
+# Cached results keep the offsets of the logs they were graded with, so
+# those stay readable after the path is reused by a later run.
+
+import sys, os, zlib, threading, collections
+
+from submission_db import SubmissionDatabase
+
+CHUNK_SIZE = 1 << 16
+
+TRUNCATED_MARKER = "\n[... %d bytes omitted ...]\n"
+
+class HeadTail:
+    """Keeps the first and last limit/2 bytes of a stream. Add() returns
+    the part of each chunk that belongs to the head; Finish() returns the
+    rest, with a marker if anything was dropped."""
+    def __init__(self, limit):
+        self.head_limit = limit // 2
+        self.tail_limit = limit - self.head_limit
+        self.head_size = 0
+        self.tail = collections.deque()
+        self.tail_size = 0
+        self.size = 0
+
+    def Add(self, data):
+        self.size += len(data)
+        n = min(len(data), self.head_limit - self.head_size)
+        self.head_size += n
+        if n < len(data):
+            self.tail.append(data[n:])
+            self.tail_size += len(data) - n
+            while self.tail_size - len(self.tail[0]) >= self.tail_limit:
+                self.tail_size -= len(self.tail.popleft())
+        return data[:n]
+
+    def Finish(self):
+        tail = ''.join(self.tail)
+        omitted = self.size - self.head_size - self.tail_limit
+        if omitted > 0:
+            return TRUNCATED_MARKER % omitted + tail[-self.tail_limit:]
+        return tail
+
+class LogCapture(threading.Thread):
+    """Copies a pipe to out_file, keeping the first and last limit/2
+    bytes of it."""
+    def __init__(self, pipe, out_file, limit):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.pipe = pipe
+        self.out_file = out_file
+        self.head_tail = HeadTail(limit)
+
+    def run(self):
+        fd = self.pipe.fileno()
+        while True:
+            data = os.read(fd, CHUNK_SIZE)
+            if not data:
+                break
+            self.out_file.write(self.head_tail.Add(data))
+        self.pipe.close()
+        self.out_file.write(self.head_tail.Finish())
+        self.out_file.flush()
+
+def Excerpt(chunks, max_bytes):
+    """Returns the first and last max_bytes/2 of the concatenated chunks."""
+    head_tail = HeadTail(max_bytes)
+    head = [head_tail.Add(data) for data in chunks]
+    return ''.join(head) + head_tail.Finish()
+
+def ReadChunks(fp):
+    while True:
+        data = fp.read(CHUNK_SIZE)
+        if not data:
+            break
+        yield data
+
+class LogStore:
+    def __init__(self, db, filename):
+        self.db = db
+        self.filename = filename
+        self.fp = file(filename, 'ab')
+
+    def Has(self, path):
+        return self.db.GetLog(path) is not None
+
+    def Add(self, path, project, name, stream):
+        """Archives the flat log file path and removes it."""
+        fp = file(path, 'rb')
+        compressor = zlib.compressobj()
+        self.fp.seek(0, os.SEEK_END)
+        offset = self.fp.tell()
+        size = 0
+        for data in ReadChunks(fp):
+            size += len(data)
+            self.fp.write(compressor.compress(data))
+        self.fp.write(compressor.flush())
+        fp.close()
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+        length = self.fp.tell() - offset
+        self.db.AddLog(path, project, name, stream, offset, length, size)
+        os.remove(path)
+
+    def Link(self, path, project, name, stream, extent):
+        """Points path at an archived (offset, compressed length, size)."""
+        (offset, length, size) = extent
+        self.db.AddLog(path, project, name, stream, offset, length, size)
+
+    def ReadArchived(self, path):
+        """Yields the decompressed chunks of an archived log."""
+        (offset, length, size) = self.db.GetLog(path)
+        fp = file(self.filename, 'rb')
+        fp.seek(offset)
+        decompressor = zlib.decompressobj()
+        while length > 0:
+            data = fp.read(min(length, CHUNK_SIZE))
+            if not data:
+                break
+            length -= len(data)
+            yield decompressor.decompress(data)
+        yield decompressor.flush()
+        fp.close()
+
+    def Read(self, path):
+        """Yields the chunks of a log, archived or still a flat file."""
+        if self.Has(path):
+            return self.ReadArchived(path)
+        if os.path.exists(path):
+            return ReadChunks(file(path, 'rb'))
+        return iter([])
+
+    def ReadExcerpt(self, path, max_bytes):
+        return Excerpt(self.Read(path), max_bytes)
+
+    def Compact(self):
+        """Rewrites the data file without the logs of earlier runs. Must
+        not run while the monitor is running."""
+        tmp_filename = self.filename + '.tmp'
+        src = file(self.filename, 'rb')
+        dst = file(tmp_filename, 'wb')
+        offsets = {}
+        for (offset, length) in self.db.LogExtents():
+            offsets[offset] = dst.tell()
+            src.seek(offset)
+            while length > 0:
+                data = src.read(min(length, CHUNK_SIZE))
+                length -= len(data)
+                dst.write(data)
+        src.close()
+        dst.flush()
+        os.fsync(dst.fileno())
+        dst.close()
+        self.db.MoveLogs(offsets)
+        os.rename(tmp_filename, self.filename)
+        self.fp.close()
+        self.fp = file(self.filename, 'ab')
+
+    def Close(self):
+        self.fp.close()
+
+if __name__ == '__main__':
+    if len(sys.argv) < 4:
+        print "usage: %s <db.sqlite> <db.logs> cat <log path>" % sys.argv[0]
+        print "       %s <db.sqlite> <db.logs> failed <project> <status_pattern> <stream>" % sys.argv[0]
+        print "       %s <db.sqlite> <db.logs> compact" % sys.argv[0]
+        sys.exit(1)
+
+    db = SubmissionDatabase(sys.argv[1])
+    store = LogStore(db, sys.argv[2])
+    if sys.argv[3] == 'cat' and len(sys.argv) == 5:
+        for data in store.Read(sys.argv[4]):
+            sys.stdout.write(data)
+    elif sys.argv[3] == 'failed' and len(sys.argv) == 7:
+        for (name, path) in db.FindLogs(sys.argv[4], sys.argv[5], sys.argv[6]):
+            print "==> %s <==" % name
+            for data in store.Read(path):
+                sys.stdout.write(data)
+    elif sys.argv[3] == 'compact':
+        store.Compact()
+    else:
+        sys.stderr.write("error: unknown command %s\n" % sys.argv[3])
+        sys.exit(1)
+    store.Close()
+    db.Close()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+#
+# Metrics for the submission monitor.
+#
+# Records how long each monitor phase takes, how many actions are queued
+# and running, how long actions run, and per-project submission counts by
+# status. Write() saves a snapshot to <website_path>/metrics.prom (Prometheus
+# text format, for node_exporter's textfile collector) and metrics.json.
+
+import time, json
+
+from file_util import WriteFileAtomic
+
+PREFIX = 'submit_monitor'
+
+# Statuses reported per project; every 'failed(...)' status counts as failed.
+STATUSES = ['queued', 'running', 'completed', 'failed', 'killed',
+            'file_too_large', 'rejected']
+
+def TimedPhase(method):
+    """Decorates a MonitorSSHLocation method so that its duration is
+    recorded as a phase in self.metrics."""
+    def wrapper(self, *args, **kwargs):
+        start = time.time()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self.metrics.RecordPhase(method.__name__, time.time() - start)
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+class MonitorMetrics:
+    def __init__(self, config):
+        self.config = config
+        self.started = time.time()
+        # phase -> [last duration, total duration, runs]
+        self.phases = {}
+        # project -> [total action secs, actions finished]
+        self.actions = {}
+
+    def RecordPhase(self, phase, elapsed):
+        stats = self.phases.setdefault(phase, [0.0, 0.0, 0])
+        stats[0] = elapsed
+        stats[1] += elapsed
+        stats[2] += 1
+
+    def RecordAction(self, project, elapsed):
+        stats = self.actions.setdefault(project, [0.0, 0])
+        stats[0] += elapsed
+        stats[1] += 1
+
+    def CountStatus(self, db, project):
+        counts = dict([(status, 0) for status in STATUSES])
+        for (status, n) in db.CountStatus(project).iteritems():
+            if status.startswith('failed'):
+                status = 'failed'
+            if status in counts:
+                counts[status] += n
+        return counts
+
+    def Snapshot(self, monitor):
+        projects = {}
+        for project in self.config.projects:
+            stats = self.actions.get(project.name, [0.0, 0])
+            projects[project.name] = {
+                'submissions': self.CountStatus(monitor.db, project.name),
+                'action_seconds_sum': stats[0],
+                'action_seconds_count': stats[1]}
+        return {'updated': time.time(),
+                'uptime': time.time() - self.started,
+                'queue_depth': len(monitor.action_queue),
+                'running_actions': len(monitor.running),
+                'phases': dict([(phase, {'last_seconds': stats[0],
+                                         'seconds_total': stats[1],
+                                         'runs_total': stats[2]})
+                                for (phase, stats) in self.phases.iteritems()]),
+                'projects': projects}
+
+    def FormatPrometheus(self, snapshot):
+        lines = []
+        def metric(name, kind, help_text, samples):
+            lines.append("# HELP %s_%s %s" % (PREFIX, name, help_text))
+            lines.append("# TYPE %s_%s %s" % (PREFIX, name, kind))
+            for (labels, value) in samples:
+                label_str = ','.join(['%s="%s"' % (k, v) for (k, v) in labels])
+                if label_str:
+                    label_str = '{' + label_str + '}'
+                lines.append("%s_%s%s %r" % (PREFIX, name, label_str, float(value)))
+
+        phases = sorted(snapshot['phases'].iteritems())
+        projects = sorted(snapshot['projects'].iteritems())
+        metric('updated_timestamp_seconds', 'gauge',
+               'Time the metrics were written.', [([], snapshot['updated'])])
+        metric('queue_depth', 'gauge', 'Actions waiting for a worker slot.',
+               [([], snapshot['queue_depth'])])
+        metric('running_actions', 'gauge', 'Actions currently running.',
+               [([], snapshot['running_actions'])])
+        metric('phase_last_seconds', 'gauge',
+               'Duration of the latest run of each monitor phase.',
+               [([('phase', p)], s['last_seconds']) for (p, s) in phases])
+        metric('phase_seconds_total', 'counter',
+               'Total time spent in each monitor phase.',
+               [([('phase', p)], s['seconds_total']) for (p, s) in phases])
+        metric('phase_runs_total', 'counter',
+               'Number of runs of each monitor phase.',
+               [([('phase', p)], s['runs_total']) for (p, s) in phases])
+        metric('action_seconds_sum', 'counter',
+               'Total wall time of finished actions.',
+               [([('project', p)], s['action_seconds_sum']) for (p, s) in projects])
+        metric('action_seconds_count', 'counter',
+               'Number of finished actions.',
+               [([('project', p)], s['action_seconds_count']) for (p, s) in projects])
+        samples = []
+        for (project, stats) in projects:
+            for status in STATUSES:
+                samples.append(([('project', project), ('status', status)],
+                                stats['submissions'][status]))
+        metric('submissions', 'gauge', 'Submissions by current status.',
+               samples)
+        return '\n'.join(lines) + '\n'
+
+    def Write(self, monitor):
+        snapshot = self.Snapshot(monitor)
+        webroot = self.config.website_path
+        WriteFileAtomic(webroot + "/metrics.prom",
+                        self.FormatPrometheus(snapshot))
+        WriteFileAtomic(webroot + "/metrics.json",
+                        json.dumps(snapshot, sort_keys=True))
@@ -11,11 +11,60 @@
 
 from datetime import *
 import sys, csv, time, subprocess, os
-import paramiko
+import threading, Queue, socket, pickle
+import resource, signal, errno, math, shutil, hashlib, json
 import ConfigParser
+from submission_db import SubmissionDatabase, ProjectRecords
+from extract_cache import ExtractCache, ArchiveError, CACHE_ENV, HashFile
+from notify import Notifier
+from monitor_metrics import MonitorMetrics, TimedPhase
+from work_queue import WorkQueue, RemoteJob, QueueCollector
+from log_store import LogStore, LogCapture
+from admission import Candidate, Rejected, MakeCheck
+from warm_pool import WarmPool
+from prefetch import Prefetcher, STAGED_ENV
+from file_util import WriteFileAtomic
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 VERSION = "0.8"
 
+# Limit on open files for every action.
+MAX_OPEN_FILES = 1024
+
+# Seconds to wait after an inotify event before scanning, so that
+# submissions still being written are picked up whole.
+SETTLE_TIME = 0.5
+
+# Submissions per page of a project's status page and JSON shards.
+STATUS_PAGE_SIZE = 100
+
+# Status changes kept in each project's <project>.changes.json.
+STATUS_CHANGES_KEPT = 200
+
+# Scripts copied from JS_DIR to the website for the status pages.
+JS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'js')
+STATUS_SCRIPTS = ['sorttable.js', 'status.js']
+
+STATUS_SCRIPT_HTML = """
+<div id="pager"></div>
+<div id="changes"></div>
+<script src="sorttable.js"></script>
+<script src="status.js"></script>
+<script>status_page.init({project}, {pages}, "{tag}");</script>
+"""
+
 PAGE_TITLE_HTML =  """
   <h1>Submission monitor: {username}</h1>
   <h4>Updated: {updated}, version {version}</h4>
@@ -44,7 +93,7 @@ PROJECT_ROW_HTML = """
 </tr>"""
 
 SUBMISSION_TABLE_HTML = """
-<table>
+<table class="sortable" id="submissions">
 <tr>
   <th>Name</th>
   <th>Size</th>
@@ -63,11 +112,38 @@ SUBMISSION_ROW_HTML = """
 """
 
 class ProjectConfig:
-    def __init__(self, name, action, size_limit, time_limit):
+    def __init__(self, name, action, size_limit, time_limit,
+                 max_concurrency=0, priority=1.0, cpu_limit=0,
+                 memory_limit=0, output_limit=0, result_cache=False,
+                 log_limit=10, admission=None, persistent_workers=0,
+                 persistent_jobs=100):
         self.name = name              
         self.action = action
         self.size_limit = size_limit
         self.time_limit = time_limit
+        # Maximum number of actions of this project run at once (0 = only
+        # bounded by the global max_workers).
+        self.max_concurrency = max_concurrency
+        # Relative share of worker slots when several projects are queued.
+        self.priority = priority
+        # Resource limits for the action's process: CPU seconds, address
+        # space (MB) and size of any file written (MB). 0 means unlimited.
+        self.cpu_limit = cpu_limit
+        self.memory_limit = memory_limit
+        self.output_limit = output_limit
+        # Whether byte-identical resubmissions reuse an earlier result
+        # instead of running the action again.
+        self.result_cache = result_cache
+        # Bytes (MB) kept of each of the action's stdout and stderr: the
+        # first and last half of it. 0 keeps everything.
+        self.log_limit = log_limit
+        # Checks from admission.py a submission must pass to be queued.
+        self.admission = admission or []
+        # Number of long-lived action processes fed jobs over a pipe (see
+        # warm_pool.py), and jobs each runs before it is restarted. 0 starts
+        # the action afresh for every submission.
+        self.persistent_workers = persistent_workers
+        self.persistent_jobs = persistent_jobs
         
 class MonitorConfig:
     def __init__(self, filename):
@@ -90,6 +166,22 @@ class MonitorConfig:
             self.hostname = config.get('Monitor', 'hostname')
             self.private_key_file = config.get('Monitor', "private_key_file")
             self.private_key_passphrase =  config.get('Monitor', 'private_key_passphrase')
+            self.port = 22
+            if config.has_option('Monitor', 'port'):
+                self.port = config.getint('Monitor', 'port')
+            # Number of SFTP channels used to list project directories.
+            self.sftp_channels = 4
+            if config.has_option('Monitor', 'sftp_channels'):
+                self.sftp_channels = config.getint('Monitor', 'sftp_channels')
+
+        # Local directory remote submissions are downloaded to ahead of
+        # their actions, with prefetch_workers transfers at a time.
+        self.staging_dir = None
+        self.prefetch_workers = 2
+        if not self.is_local and config.has_option('Monitor', 'staging_dir'):
+            self.staging_dir = config.get('Monitor', 'staging_dir')
+        if config.has_option('Monitor', 'prefetch_workers'):
+            self.prefetch_workers = config.getint('Monitor', 'prefetch_workers')
 
         self.website_path = config.get('Monitor','website_path')
         self.website_header = config.get('Monitor', 'website_header')
@@ -98,6 +190,71 @@ class MonitorConfig:
         self.notify_action = config.get('Monitor', 'notify_action')
         self.notify_complete = config.get('Monitor', 'notify_complete')
 
+        # Number of actions that may run concurrently across all projects.
+        self.max_workers = 1
+        if config.has_option('Monitor', 'max_workers'):
+            self.max_workers = max(1, config.getint('Monitor', 'max_workers'))
+
+        # Mail is sent over SMTP if smtp_host is set, otherwise with mail(1).
+        self.smtp_host = None
+        self.smtp_port = 25
+        self.mail_from = self.username
+        if config.has_option('Monitor', 'smtp_host'):
+            self.smtp_host = config.get('Monitor', 'smtp_host')
+        if config.has_option('Monitor', 'smtp_port'):
+            self.smtp_port = config.getint('Monitor', 'smtp_port')
+        if config.has_option('Monitor', 'mail_from'):
+            self.mail_from = config.get('Monitor', 'mail_from')
+
+        # Directory for the shared cache of extracted submissions.
+        self.extract_cache = None
+        if config.has_option('Monitor', 'extract_cache'):
+            self.extract_cache = config.get('Monitor', 'extract_cache')
+        self.extract_cache_max_mb = 10000
+        if config.has_option('Monitor', 'extract_cache_max_mb'):
+            self.extract_cache_max_mb = config.getint('Monitor',
+                                                      'extract_cache_max_mb')
+
+        # Seconds between full re-stats of local project directories.
+        self.full_scan_interval = 300
+        if config.has_option('Monitor', 'full_scan_interval'):
+            self.full_scan_interval = config.getfloat('Monitor', 'full_scan_interval')
+
+        # Minimum number of seconds between status website rewrites while
+        # actions are being processed.
+        self.render_interval = 2
+        if config.has_option('Monitor', 'render_interval'):
+            self.render_interval = config.getfloat('Monitor', 'render_interval')
+
+        # Bounds on the daemon's polling interval, in seconds.
+        self.poll_min = 1
+        self.poll_max = 60
+        if config.has_option('Monitor', 'poll_min'):
+            self.poll_min = config.getint('Monitor', 'poll_min')
+        if config.has_option('Monitor', 'poll_max'):
+            self.poll_max = config.getint('Monitor', 'poll_max')
+
+        # Bytes of each log included in failure emails (first and last half).
+        self.email_log_bytes = 16384
+        if config.has_option('Monitor', 'email_log_bytes'):
+            self.email_log_bytes = config.getint('Monitor', 'email_log_bytes')
+
+        # Shared directory of the work queue. If set, actions are published
+        # there and run by grading_worker.py processes, on this or other
+        # hosts, instead of by the monitor itself. max_workers then bounds
+        # the number of published jobs.
+        self.work_queue = None
+        self.lease_time = 60
+        if config.has_option('Monitor', 'work_queue'):
+            self.work_queue = config.get('Monitor', 'work_queue')
+        if config.has_option('Monitor', 'lease_time'):
+            self.lease_time = config.getfloat('Monitor', 'lease_time')
+
+        # Parent of the workspaces of persistent workers.
+        self.workspace_dir = './workspaces'
+        if config.has_option('Monitor', 'workspace_dir'):
+            self.workspace_dir = config.get('Monitor', 'workspace_dir')
+
         project_sections = [section for section in config.sections()
                             if section.startswith('Project')]
         assert len(project_sections) > 0, "must have at least one project to monitor"
@@ -105,59 +262,902 @@ class MonitorConfig:
         self.projects = []
         for project in project_sections:
             print "Found project: %s = %s " % (project , config.get(project, 'name'))
+            max_concurrency = 0
+            if config.has_option(project, 'max_concurrency'):
+                max_concurrency = config.getint(project, 'max_concurrency')
+            priority = 1.0
+            if config.has_option(project, 'priority'):
+                priority = config.getfloat(project, 'priority')
+                assert priority > 0, "priority must be positive"
+            options = {}
+            for key in ['cpu_limit', 'memory_limit', 'output_limit',
+                        'log_limit']:
+                if config.has_option(project, key):
+                    options[key] = config.getfloat(project, key)
+            for key in ['persistent_workers', 'persistent_jobs']:
+                if config.has_option(project, key):
+                    options[key] = config.getint(project, key)
+            # A project's actions cannot outnumber its persistent workers.
+            workers = options.get('persistent_workers', 0)
+            if workers > 0 and (max_concurrency == 0 or max_concurrency > workers):
+                max_concurrency = workers
+            if config.has_option(project, 'result_cache'):
+                options['result_cache'] = config.getboolean(project, 'result_cache')
+            if config.has_option(project, 'admit'):
+                project_options = dict(config.items(project))
+                options['admission'] = [
+                    MakeCheck(name.strip(), project_options)
+                    for name in config.get(project, 'admit').split(',')]
             self.projects.append(ProjectConfig(
                     config.get(project, 'name'),
                     config.get(project, 'action'),
                     config.getfloat(project, 'size_limit'),
-                    config.getfloat(project, 'time_limit')))
+                    config.getfloat(project, 'time_limit'),
+                    max_concurrency, priority, **options))
 
-class MonitorSSHLocation:
+def ActionLimits(action):
+    """Returns the (resource, limit) pairs to apply to an action's process,
+    capped at the monitor's own hard limits."""
+    limits = [(resource.RLIMIT_NOFILE, MAX_OPEN_FILES)]
+    if action['cpu_limit'] > 0:
+        limits.append((resource.RLIMIT_CPU, int(math.ceil(action['cpu_limit']))))
+    if action['memory_limit'] > 0:
+        limits.append((resource.RLIMIT_AS, int(action['memory_limit']*1e6)))
+    if action['output_limit'] > 0:
+        limits.append((resource.RLIMIT_FSIZE, int(action['output_limit']*1e6)))
+
+    capped = []
+    for (rlimit, value) in limits:
+        hard = resource.getrlimit(rlimit)[1]
+        if hard != resource.RLIM_INFINITY:
+            value = min(value, hard)
+        capped.append((rlimit, value))
+    return capped
+
+class ActionSlot(threading.Thread):
+    """Runs a single action in a worker slot.
+
+    The action is started in a new session, so it and everything it spawns
+    share one process group, and with the action's resource limits. The
+    thread blocks in wait4() on the child; a timer kills the whole group
+    once the action's timeout expires, and anything left in the group when
+    the child exits is killed as well. The slot then puts itself on
+    done_queue so the monitor can record the result and resource usage.
+
+    With a log_limit, the action's output goes through pipes to LogCapture
+    threads, which keep only the head and tail of it. An action whose
+    submission is being prefetched starts once the transfer has ended.
+    """
+    def __init__(self, action, args, stdout, stderr, done_queue):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.action = action
+        self.args = args
+        self.stdout = stdout
+        self.stderr = stderr
+        self.done_queue = done_queue
+        self.limits = ActionLimits(action)
+        self.log_limit = int(action.get('log_limit', 0) * 1e6)
+        self.process = None
+        self.lock = threading.Lock()
+        self.reaped = False
+        self.killed = False
+        self.returncode = None
+        self.error = None
+        self.start_time = None
+        self.elapsed = 0
+        self.cpu_time = None
+        self.max_rss = None
+
+    def SetupChild(self):
+        # Runs in the child between fork and exec.
+        os.setsid()
+        for (rlimit, value) in self.limits:
+            resource.setrlimit(rlimit, (value, value))
+
+    def KillGroup(self):
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except OSError:
+            pass # group already gone
+
+    def Kill(self):
+        with self.lock:
+            if self.reaped:
+                return
+            self.killed = True
+            print "Process is overtime after %.2f secs" % (
+                time.time() - self.start_time)
+            self.KillGroup()
+
+    def WaitStaged(self):
+        """Waits for the monitor's copy of a remote submission. Returns
+        the action's environment, or None to inherit the monitor's."""
+        staged = self.action.get('staged')
+        if staged is None:
+            return None
+        path = staged.Wait()
+        if path is None:
+            return None
+        env = dict(os.environ)
+        env[STAGED_ENV] = os.path.abspath(path)
+        return env
+
+    def Wait(self):
+        while True:
+            try:
+                return os.wait4(self.process.pid, 0)
+            except OSError as err:
+                if err.errno != errno.EINTR:
+                    raise
+
+    def run(self):
+        env = self.WaitStaged()
+        self.start_time = time.time()
+        timer = None
+        captures = []
+        try:
+            if self.log_limit > 0:
+                self.process = subprocess.Popen(self.args,
+                                                stdout=subprocess.PIPE,
+                                                stderr=subprocess.PIPE,
+                                                preexec_fn=self.SetupChild,
+                                                close_fds=True, env=env)
+                captures = [
+                    LogCapture(self.process.stdout, self.stdout, self.log_limit),
+                    LogCapture(self.process.stderr, self.stderr, self.log_limit)]
+                for capture in captures:
+                    capture.start()
+            else:
+                self.process = subprocess.Popen(self.args, stdout=self.stdout,
+                                                stderr=self.stderr,
+                                                preexec_fn=self.SetupChild,
+                                                close_fds=True, env=env)
+            timer = threading.Timer(self.action['timeout'], self.Kill)
+            timer.daemon = True
+            timer.start()
+            (pid, status, rusage) = self.Wait()
+            with self.lock:
+                self.reaped = True
+            if os.WIFSIGNALED(status):
+                self.returncode = -os.WTERMSIG(status)
+            else:
+                self.returncode = os.WEXITSTATUS(status)
+            self.process.returncode = self.returncode
+            if self.returncode == -signal.SIGXCPU:
+                self.killed = True
+            self.cpu_time = rusage.ru_utime + rusage.ru_stime
+            self.max_rss = rusage.ru_maxrss
+            # Reap anything the action left running in its group, which
+            # also closes the pipes of any that held them open.
+            self.KillGroup()
+            for capture in captures:
+                capture.join(SETTLE_TIME * 10)
+        except OSError as err:
+            self.error = err
+        finally:
+            if timer is not None:
+                timer.cancel()
+            self.elapsed = time.time() - self.start_time
+            self.stdout.close()
+            self.stderr.close()
+            self.done_queue.put(self)
+
+def SubmissionUser(filename):
+    """Returns the username a submission file belongs to."""
+    if filename.endswith('.Z'):
+        return filename[:-2]
+    return filename
+
+class ActionScheduler:
+    """Actions waiting for a worker slot.
+
+    Only the newest version of each (project, filename) is kept queued. Pop
+    hands actions out fair-share: projects take turns in proportion to their
+    priority, and within a project users take turns, oldest action first.
+    Turns are tracked as virtual times; a project or user that becomes
+    active again starts from the current minimum instead of its old value,
+    so being idle does not earn it a burst.
+    """
+    def __init__(self):
+        self.actions = []
+        self.project_vtime = {}
+        self.user_vtime = {}
+
+    def __len__(self):
+        return len(self.actions)
+
+    def __iter__(self):
+        return iter(self.actions)
+
+    def index(self, action):
+        return self.actions.index(action)
+
+    def Remove(self, project, filename):
+        """Removes and returns the queued action for (project, filename),
+        or None."""
+        for (i, queued) in enumerate(self.actions):
+            if (queued['project'] == project and
+                queued['submission'].filename == filename):
+                print "Superseding queued submission %s/%s" % (project, filename)
+                return self.actions.pop(i)
+        return None
+
+    def Add(self, action):
+        project = action['project']
+        filename = action['submission'].filename
+        self.Remove(project, filename)
+
+        user = (project, SubmissionUser(filename))
+        active_projects = set([a['project'] for a in self.actions])
+        active_users = set([(a['project'], SubmissionUser(a['submission'].filename))
+                            for a in self.actions if a['project'] == project])
+        if project not in active_projects and len(active_projects) > 0:
+            floor = min([self.project_vtime.get(p, 0) for p in active_projects])
+            self.project_vtime[project] = max(
+                self.project_vtime.get(project, 0), floor)
+        if user not in active_users and len(active_users) > 0:
+            floor = min([self.user_vtime.get(u, 0) for u in active_users])
+            self.user_vtime[user] = max(self.user_vtime.get(user, 0), floor)
+
+        self.actions.append(action)
+
+    def Pop(self, can_start):
+        """Removes and returns the next action for which can_start(action)
+        is true, or None."""
+        best = None
+        best_key = None
+        for action in self.actions:
+            if not can_start(action):
+                continue
+            project = action['project']
+            user = (project, SubmissionUser(action['submission'].filename))
+            key = (self.project_vtime.get(project, 0),
+                   self.user_vtime.get(user, 0))
+            if best is None or key < best_key:
+                best = action
+                best_key = key
+
+        if best is not None:
+            self.actions.remove(best)
+            project = best['project']
+            user = (project, SubmissionUser(best['submission'].filename))
+            self.project_vtime[project] = (self.project_vtime.get(project, 0) +
+                                           1.0 / best['priority'])
+            self.user_vtime[user] = self.user_vtime.get(user, 0) + 1
+        return best
+
+class SubmissionWatcher(threading.Thread):
+    """Tells the daemon when it is worth rescanning target_dir.
+
+    Local targets are watched with inotify (if pyinotify is installed);
+    otherwise, and for remote targets, the watcher polls with an interval
+    that doubles while scans find nothing and resets once they do. Each
+    trigger is delivered by putting None on the events queue. With inotify,
+    the paths of the events are collected for the next scan to re-stat.
+    """
+    def __init__(self, config, events):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.config = config
+        self.events = events
+        self.interval = config.poll_min
+        self.scanned = threading.Event()
+        self.inotify = config.is_local and pyinotify is not None
+        self.watching = False
+        self.lock = threading.Lock()
+        # Paths reported since the last TakeChanged(); None until the watch
+        # is set up or after the event queue overflowed.
+        self.changed_paths = None
+
+    def TakeChanged(self):
+        """Returns the set of paths changed since the last call, or None if
+        changes may have gone unreported."""
+        with self.lock:
+            paths = self.changed_paths
+            if self.watching:
+                self.changed_paths = set()
+            return paths
+
+    def RecordEvent(self, event):
+        with self.lock:
+            if event.mask & pyinotify.IN_Q_OVERFLOW:
+                self.changed_paths = None
+            elif self.changed_paths is not None:
+                self.changed_paths.add(event.pathname)
+
+    def Reset(self):
+        self.interval = self.config.poll_min
+        self.scanned.set()
+
+    def Backoff(self):
+        self.interval = min(self.interval * 2, self.config.poll_max)
+        self.scanned.set()
+
+    def ScanFailed(self):
+        """Backs off, and makes the next scan re-stat everything since the
+        changes taken for the failed one were not processed."""
+        with self.lock:
+            self.changed_paths = None
+        self.Backoff()
+
+    def run(self):
+        if self.inotify:
+            self.RunInotify()
+        else:
+            self.RunPolling()
+
+    def RunPolling(self):
+        print "Polling %s every %d-%d secs" % (
+            self.config.target_dir, self.config.poll_min, self.config.poll_max)
+        while True:
+            # Start timing only once the previous scan has finished and
+            # picked the next interval.
+            self.scanned.wait()
+            self.scanned.clear()
+            time.sleep(self.interval)
+            self.events.put(None)
+
+    def RunInotify(self):
+        print "Watching %s with inotify" % self.config.target_dir
+        mask = (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO |
+                pyinotify.IN_ATTRIB | pyinotify.IN_CREATE)
+        wm = pyinotify.WatchManager()
+        notifier = pyinotify.Notifier(wm, default_proc_fun=self.RecordEvent)
+        wm.add_watch(self.config.target_dir, mask, rec=True, auto_add=True)
+        # Anything changed before the watch was set up is caught by the
+        # first scan, which re-stats every entry.
+        with self.lock:
+            self.watching = True
+        while True:
+            # Rescan at least every poll_max seconds in case events are lost.
+            if notifier.check_events(timeout=self.config.poll_max * 1000):
+                notifier.read_events()
+                notifier.process_events()
+                # Let submissions finish being copied before scanning.
+                time.sleep(SETTLE_TIME)
+                while notifier.check_events(timeout=0):
+                    notifier.read_events()
+                    notifier.process_events()
+            self.events.put(None)
+
+class StatusRenderer:
+    """Renders the status website.
+
+    Projects are marked dirty as their records change; Render() rewrites
+    only the dirty project pages and the index, and unless forced does so
+    at most once every render_interval seconds.
+
+    Each project page shows the first STATUS_PAGE_SIZE submissions and is
+    kept current by status.js, which reads JSON written next to it:
+    <project>.json (counts, a change sequence number and a tag per page),
+    <project>.<n>.json (page n of the submissions, by name) and
+    <project>.changes.json (the latest status changes). A shard is only
+    rewritten when its contents change, so clients refetch only the pages
+    that did.
+    """
     def __init__(self, config):
         self.config = config
+        self.header_html = file(config.website_header, "r").read()
+        self.footer_html = file(config.website_footer, "r").read()
+        # Pages are kept from earlier runs; only missing ones are dirty.
+        self.dirty = set([p.name for p in config.projects
+                          if not os.path.exists(self.PageFile(p.name))])
+        self.index_dirty = True
+        self.counts = {}
+        self.db = None
+        self.last_render = 0
+        # (project, page) -> tag of the shard last written.
+        self.shard_tags = {}
+        # project -> recent changes as [seq, name, size, submitted, status,
+        # updated]; seq increases across restarts.
+        self.changes = {}
+        self.seq = int(time.time() * 1000)
+        self.InstallScripts()
+
+    def InstallScripts(self):
+        for name in STATUS_SCRIPTS:
+            src = os.path.join(JS_DIR, name)
+            dst = os.path.join(self.config.website_path, name)
+            if (not os.path.exists(dst) or
+                os.path.getmtime(dst) < os.path.getmtime(src)):
+                shutil.copyfile(src, dst)
+
+    def PageFile(self, name):
+        return self.config.website_path + "/" + name + ".html"
+
+    def ShardFile(self, project, suffix):
+        return "%s/%s.%s.json" % (self.config.website_path, project, suffix)
+
+    def MarkDirty(self, project, rec=None):
+        self.dirty.add(project)
+        self.index_dirty = True
+        if rec is not None:
+            self.seq = max(self.seq + 1, int(time.time() * 1000))
+            changes = self.changes.setdefault(project, [])
+            changes.append([self.seq] + self.MakeRow(rec))
+            del changes[:-STATUS_CHANGES_KEPT]
+
+    def MakeRow(self, rec):
+        return [rec['name'], rec['size'], int(float(rec['timestamp'])),
+                rec['status'], int(float(rec['updated']))]
+
+    def CountStatus(self, project):
+        counts = {'num_submissions': 0, 'num_queued': 0,
+                  'num_completed': 0, 'num_running': 0, 'num_failed': 0}
+        for (status, n) in self.db.CountStatus(project).iteritems():
+            counts['num_submissions'] += n
+            if status == 'queued':
+                counts['num_queued'] += n
+            elif status == 'completed':
+                counts['num_completed'] += n
+            elif status == 'running':
+                counts['num_running'] += n
+            elif (status.startswith('failed') or status == 'killed' or
+                  status == 'file_too_large' or status == 'rejected'):
+                counts['num_failed'] += n
+        return counts
+
+    def WriteShards(self, project, data):
+        """Writes the JSON shards of a project whose records are data,
+        sorted by name. Returns the tags of its pages."""
+        rows = [self.MakeRow(rec) for rec in data]
+        tags = []
+        for start in range(0, max(len(rows), 1), STATUS_PAGE_SIZE):
+            page = len(tags)
+            text = json.dumps(rows[start:start + STATUS_PAGE_SIZE],
+                              separators=(',', ':'))
+            tag = hashlib.sha1(text).hexdigest()[:12]
+            if self.shard_tags.get((project, page)) != tag:
+                WriteFileAtomic(self.ShardFile(project, page), text)
+                self.shard_tags[(project, page)] = tag
+            tags.append(tag)
+
+        changes = self.changes.get(project, [])
+        WriteFileAtomic(self.ShardFile(project, 'changes'),
+                        json.dumps({'seq': self.seq, 'rows': changes},
+                                   separators=(',', ':')))
+        index = {'updated': int(time.time()), 'seq': self.seq,
+                 'page_size': STATUS_PAGE_SIZE, 'total': len(rows),
+                 'pages': tags, 'counts': self.counts[project]}
+        WriteFileAtomic("%s/%s.json" % (self.config.website_path, project),
+                        json.dumps(index, separators=(',', ':')))
+        return tags
+
+    def RenderDelay(self):
+        """Returns the secs until dirty pages are due to be rendered, or
+        None if none are dirty."""
+        if not self.index_dirty:
+            return None
+        return max(0, self.last_render + self.config.render_interval -
+                   time.time())
+
+    def Render(self, project_data, force=True):
+        """Rewrites the dirty pages if due. Returns True if it did."""
+        if not self.index_dirty:
+            return False
+        if not force and time.time() - self.last_render < self.config.render_interval:
+            return False
+
+        title_html = PAGE_TITLE_HTML.format(username=self.config.username,
+                                            version=VERSION,
+                                            updated=str(datetime.now()))
+
+        # Update dirty project websites.
+        for project in self.config.projects:
+            if project.name not in self.dirty:
+                continue
+            data = sorted(project_data[project.name].values(),
+                    key=lambda x: x['name']) # Sort by name
+            self.counts[project.name] = self.CountStatus(project.name)
+            tags = self.WriteShards(project.name, data)
+
+            html = [self.header_html, title_html,
+                    "<p><a href='index.html'>Back to Overview</a></p>",
+                    "<h2>Project Submissions: %s</h2>\n" % project.name,
+                    SUBMISSION_TABLE_HTML]
+            for row in data[:STATUS_PAGE_SIZE]:
+                html.append(SUBMISSION_ROW_HTML.format(
+                        name=row['name'],
+                        size=row['size'] + ' MB', 
+                        submitted=str(
+                            datetime.fromtimestamp(float(row['timestamp']))),
+                        status=row['status'] + ' (' + 
+                        str(datetime.fromtimestamp(float(row['updated']))) + ')'))
+            html.append('\n</table>\n')
+            html.append(STATUS_SCRIPT_HTML.format(project=json.dumps(project.name),
+                                                  pages=len(tags), tag=tags[0]))
+            html.append('\n' + self.footer_html)
+            WriteFileAtomic(self.PageFile(project.name), ''.join(html))
 
-        # initialize empty database etc.
-        self.action_queue = list()
-        self.project_data = {}
+        # Update master index page.
+        html = [self.header_html, title_html, PROJECT_TABLE_HTML,
+                "<h2>Project Overviews</h2>"]
         for project in self.config.projects:
-            self.project_data[project.name] = {}
+            if project.name not in self.counts:
+                self.counts[project.name] = self.CountStatus(project.name)
+            html.append(PROJECT_ROW_HTML.format(name=project.name,
+                                                **self.counts[project.name]))
+        html.append("\n</table>\n\n" + self.footer_html)
+        WriteFileAtomic(self.PageFile("index"), ''.join(html))
+
+        self.dirty.clear()
+        self.index_dirty = False
+        self.last_render = time.time()
+        return True
+
+# paramiko is only needed for remote targets, so it is imported when the
+# first SFTPConnection is made and local monitors start without it.
+paramiko = None
+
+def ImportParamiko():
+    global paramiko
+    import paramiko
+
+def ScanErrors():
+    """Returns the errors a scan can fail with when the target is
+    unreachable or unreadable, for the daemon to survive."""
+    errors = (socket.error, EOFError, IOError, OSError)
+    if paramiko is not None:
+        errors += (paramiko.SSHException,)
+    return errors
+
+class SubmissionAttributes:
+    """The subset of paramiko.SFTPAttributes used for local submissions."""
+    def __init__(self, filename, st_size, st_mtime):
+        self.filename = filename
+        self.st_size = st_size
+        self.st_mtime = st_mtime
+
+def ListingDigest(submission_attr):
+    """Returns a digest of the names, sizes and mtimes of a project's
+    submissions, as compared against the database."""
+    sha1 = hashlib.sha1()
+    for (name, size, mtime) in sorted([(a.filename, int(a.st_size), int(a.st_mtime))
+                                       for a in submission_attr]):
+        sha1.update("%s\0%d\0%d\n" % (name, size, mtime))
+    return sha1.hexdigest()
+
+class LocalScanner:
+    """Lists submissions in a local target_dir incrementally.
+
+    A snapshot of each project directory's mtime and of every entry's
+    (inode, size, mtime) is kept between scans and saved next to the
+    database. A submission overwritten in place changes neither the
+    directory's mtime nor its inode, so the snapshot is only trusted when
+    inotify reports which paths changed: directories whose mtime has not
+    changed are then not read, only new or replaced entries and the
+    reported paths are stat'ed, and every project is still fully
+    re-stat'ed once every full_scan_interval seconds in case events were
+    lost. Without that report every entry is re-stat'ed.
+    """
+    def __init__(self, config):
+        self.config = config
+        self.snapshot_file = './db/' + config.username + '.snapshot'
+        self.snapshot = {}
+        if os.path.exists(self.snapshot_file):
+            try:
+                self.snapshot = pickle.load(file(self.snapshot_file, 'rb'))
+            except Exception as err:
+                print "Ignoring unreadable snapshot %s: %s" % (
+                    self.snapshot_file, str(err))
+
+    def SaveSnapshot(self):
+        tmp_filename = self.snapshot_file + '.tmp'
+        fp = file(tmp_filename, 'wb')
+        pickle.dump(self.snapshot, fp, pickle.HIGHEST_PROTOCOL)
+        fp.close()
+        os.rename(tmp_filename, self.snapshot_file)
+
+    def ScanDir(self, project_dir, old_entries):
+        entries = {}
+        if scandir is None:
+            for filename in os.listdir(project_dir):
+                st = os.stat(project_dir + "/" + filename)
+                entries[filename] = (st.st_ino, st.st_size, st.st_mtime)
+            return entries
+
+        for entry in scandir(project_dir):
+            old = old_entries.get(entry.name)
+            if old is not None and old[0] == entry.inode():
+                entries[entry.name] = old
+            else:
+                st = entry.stat()
+                entries[entry.name] = (st.st_ino, st.st_size, st.st_mtime)
+        return entries
+
+    def StatChanged(self, project_dir, entries, changed_paths):
+        """Re-stats the entries of project_dir among changed_paths. Returns
+        True if any were."""
+        project_dir = os.path.normpath(project_dir)
+        found = False
+        for path in changed_paths:
+            path = os.path.normpath(path)
+            if os.path.dirname(path) != project_dir:
+                continue
+            found = True
+            try:
+                st = os.stat(path)
+                entries[os.path.basename(path)] = (st.st_ino, st.st_size,
+                                                   st.st_mtime)
+            except OSError:
+                entries.pop(os.path.basename(path), None)
+        return found
+
+    def ListProjects(self, target_dir, project_names, changed_paths=None):
+        """Returns a dict of project -> submission attributes for each
+        project directory present in target_dir. changed_paths is the set
+        of paths inotify reported since the last scan, or None to re-stat
+        every entry."""
+        now = time.time()
+        dirlist = os.listdir(target_dir)
+        active_projects = set(project_names).intersection(set(dirlist))
+
+        listings = {}
+        changed = False
+        for project in active_projects:
+            project_dir = target_dir + "/" + project
+            dir_mtime = os.stat(project_dir).st_mtime
+            snap = self.snapshot.get(project)
+            full = (changed_paths is None or snap is None or
+                    now - snap['full_scan'] >= self.config.full_scan_interval)
+
+            # Trust an unchanged mtime only if it is older than the last scan
+            # by more than the filesystem's timestamp granularity.
+            if (not full and snap['dir_mtime'] == dir_mtime and
+                dir_mtime < snap['scanned'] - 1):
+                entries = dict(snap['entries'])
+                rescanned = False
+            else:
+                old_entries = {}
+                if not full:
+                    old_entries = snap['entries']
+                entries = self.ScanDir(project_dir, old_entries)
+                rescanned = True
+            if not full and self.StatChanged(project_dir, entries, changed_paths):
+                rescanned = True
+
+            if rescanned:
+                full_scan = now
+                if not full:
+                    full_scan = snap['full_scan']
+                self.snapshot[project] = {'dir_mtime': dir_mtime,
+                                          'scanned': now,
+                                          'full_scan': full_scan,
+                                          'entries': entries}
+                changed = True
+
+            listings[project] = [SubmissionAttributes(name, size, mtime)
+                                 for (name, (ino, size, mtime))
+                                 in entries.iteritems()]
+        if changed:
+            self.SaveSnapshot()
+        return listings
 
-        self.db_keys = ['name','size','updated', 'timestamp', 'status']
+class SFTPConnection:
+    """Keeps one SSH transport to the target host open across scans.
+
+    Several SFTP channels are opened on the transport and kept in a pool so
+    that project directories can be listed in parallel. Any connection error
+    drops the transport; the next call reconnects.
+    """
+    def __init__(self, config):
+        ImportParamiko()
+        self.config = config
+        self.client = None
+        self.private_key = None
+        self.channels = Queue.Queue()
+
+    def IsActive(self):
+        if self.client is None:
+            return False
+        transport = self.client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def Connect(self):
+        if self.IsActive():
+            return
+        self.Close()
+
+        # Initialize SSH connection to target server.
+        print "Connecting to server: %s@%s" % (self.config.username, self.config.hostname)
+        if self.private_key is None:
+            self.private_key = paramiko.RSAKey.from_private_key_file(
+                self.config.private_key_file, 
+                self.config.private_key_passphrase)
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect(hostname=self.config.hostname,
+                       port=self.config.port,
+                       username=self.config.username,
+                       pkey=self.private_key)
+        client.get_transport().set_keepalive(30)
+        self.client = client
+
+    def Close(self):
+        while True:
+            try:
+                self.channels.get_nowait().close()
+            except Queue.Empty:
+                break
+            except Exception:
+                pass
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+
+    def GetChannel(self):
+        try:
+            return self.channels.get_nowait()
+        except Queue.Empty:
+            return self.client.open_sftp()
+
+    def ReleaseChannel(self, sftp):
+        self.channels.put(sftp)
+
+    def ListDirs(self, paths):
+        """Returns a dict of path -> listdir_attr(path), listing up to
+        sftp_channels directories at a time."""
+        work = Queue.Queue()
+        for path in paths:
+            work.put(path)
+        results = {}
+        errors = []
+
+        def worker():
+            try:
+                sftp = self.GetChannel()
+            except Exception as err:
+                errors.append(err)
+                return
+            while True:
+                try:
+                    path = work.get_nowait()
+                except Queue.Empty:
+                    break
+                try:
+                    results[path] = sftp.listdir_attr(path)
+                except Exception as err:
+                    errors.append(err)
+                    sftp.close()
+                    return
+            self.ReleaseChannel(sftp)
+
+        threads = [threading.Thread(target=worker) for i in
+                   range(min(self.config.sftp_channels, len(paths)))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if len(errors) > 0:
+            raise errors[0]
+        return results
+
+    def ListProjects(self, target_dir, project_names):
+        """Returns a dict of project -> submission attributes for each
+        project directory present in target_dir."""
+        for attempt in range(2):
+            try:
+                self.Connect()
+                sftp = self.GetChannel()
+                dirlist = sftp.listdir(target_dir)
+                self.ReleaseChannel(sftp)
+                active_projects = list(set(project_names).intersection(set(dirlist)))
+                listings = self.ListDirs([target_dir + "/" + p
+                                          for p in active_projects])
+                return dict([(p, listings[target_dir + "/" + p])
+                             for p in active_projects])
+            except (socket.error, EOFError, paramiko.SSHException) as err:
+                print "Lost connection to %s: %s" % (self.config.hostname, str(err))
+                self.Close()
+                if attempt > 0:
+                    raise
+
+class MonitorSSHLocation:
+    def __init__(self, config):
+        self.config = config
+
+        # initialize empty database etc. Records are read per project by
+        # project_data once the database is open.
+        self.action_queue = ActionScheduler()
+        self.project_data = None
+
+        self.db = None
+        self.log_store = None
+
+        # Action script path -> (mtime, hash of its contents).
+        self.action_versions = {}
+
+        # Actions currently executing, keyed by their ActionSlot (or
+        # RemoteJob when grading through the work queue).
+        self.running = {}
+
+        self.work_queue = None
+        self.collector = None
+        self.job_count = 0
+        if self.config.work_queue is not None:
+            self.work_queue = WorkQueue(self.config.work_queue,
+                                        self.config.lease_time)
+            self.work_queue.Purge()
+
+        # Project name -> WarmPool, for projects with persistent workers.
+        # Unused with a work queue, whose workers start each action afresh.
+        self.pools = {}
+        if self.work_queue is None:
+            for project in self.config.projects:
+                if project.persistent_workers > 0:
+                    self.pools[project.name] = self.StartPool(project)
+
+        self.renderer = StatusRenderer(self.config)
+        self.notifier = Notifier(self.config)
+        self.metrics = MonitorMetrics(self.config)
+
+        # Downloads remote submissions while earlier ones are graded. Not
+        # used with a work queue, whose workers may be on other hosts.
+        self.prefetcher = None
+        if self.config.staging_dir is not None and self.work_queue is None:
+            self.prefetcher = Prefetcher(SFTPConnection(self.config),
+                                         self.config.target_dir,
+                                         self.config.staging_dir,
+                                         self.config.prefetch_workers)
+
+        # Persistent connection to the target host (remote mode only).
+        self.connection = None
+        self.scanner = None
+        if self.config.is_local:
+            self.scanner = LocalScanner(self.config)
+
+        # Actions find extracted submissions through the environment.
+        self.extract_cache = None
+        if self.config.extract_cache is not None:
+            self.extract_cache = ExtractCache(
+                self.config.extract_cache,
+                self.config.extract_cache_max_mb * 1000000)
+            os.environ[CACHE_ENV] = os.path.abspath(self.config.extract_cache)
+
+    def StartPool(self, project_cfg):
+        # RLIMIT_CPU would count every job a worker ever ran, so persistent
+        # workers only get the memory and output limits.
+        limits = ActionLimits({'cpu_limit': 0,
+                               'memory_limit': project_cfg.memory_limit,
+                               'output_limit': project_cfg.output_limit})
+        pool = WarmPool(project_cfg.name, project_cfg.action,
+                        project_cfg.persistent_workers,
+                        project_cfg.persistent_jobs,
+                        self.config.workspace_dir, self.config.log_dir, limits)
+        pool.StartWorkers()
+        return pool
+
+    def ClosePools(self):
+        for pool in self.pools.values():
+            pool.Close()
 
     def SendEmail(self, rcpt, subj, txt):
         if rcpt.startswith("web_"):
             print "Ignoring email to rcpt %s" % rcpt
             return
 
-        # write tmp email body
-        f = file('tmp_email_body.txt', 'w')
-        f.write(txt)
-        f.close()
-        cmd = 'mail -c "" -s "%s: %s" %s < tmp_email_body.txt' % (self.config.username, subj, rcpt)
-        os.system(cmd)
+        self.notifier.Send(rcpt, subj, txt)
                 
-    def GetActionQueue(self):
-
-        file_manager = os
-
-        if not self.config.is_local:
-            # Initialize SSH connection to target server.
-            print "Connecting to server: %s@%s" % (self.config.username, self.config.hostname)
-            private_key = paramiko.RSAKey.from_private_key_file(
-                self.config.private_key_file, 
-                self.config.private_key_passphrase)
-            client = paramiko.SSHClient()
-            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            client.connect(hostname=self.config.hostname,
-                           username=self.config.username,
-                           pkey=private_key)
-            file_manager = client.open_sftp()
+    @TimedPhase
+    def GetActionQueue(self, changed_paths=None):
+        """Scans for new submissions and queues them. Returns the newly
+        queued actions. changed_paths is passed on to LocalScanner."""
+        new_actions = []
 
         # Get list of projects from the server and compare with
         # projects we are supposed to be monitoring.
         print "Getting list of projects in directory: %s" % self.config.target_dir
-        dirlist = file_manager.listdir(self.config.target_dir)
         project_names = [p.name for p in self.config.projects]
-        active_projects = set(project_names).intersection(set(dirlist))
+        if not self.config.is_local:
+            if self.connection is None:
+                self.connection = SFTPConnection(self.config)
+            listings = self.connection.ListProjects(self.config.target_dir,
+                                                    project_names)
+        else:
+            listings = self.scanner.ListProjects(self.config.target_dir,
+                                                 project_names, changed_paths)
+        active_projects = listings.keys()
 
         print "Found %d active projects: %s" % (len(active_projects), 
                                                 ','.join(active_projects))
@@ -171,21 +1171,16 @@ class MonitorSSHLocation:
                 print "ERROR ERROR MORE THAN ONE PROJECT FOUND"
             project_cfg = project_cfg[0]
 
-            submission_attr = list()
-            project_dir = self.config.target_dir + "/" + project
-            if not self.config.is_local:
-                submission_attr = file_manager.listdir_attr(project_dir)
-            else:
-                #submission_filenames = file_manager.listdir(project_dir)
-                mtime = lambda f: file_manager.stat(project_dir+"/"+f).st_mtime
-                submission_filenames = sorted(file_manager.listdir(project_dir),
-                        key=mtime) # Sort to choose oldest submission first
-                for filename in submission_filenames:
-                    stat = paramiko.SFTPAttributes.from_stat(file_manager.stat(
-                            project_dir + "/" + filename))
-                    stat.filename = filename
-                    submission_attr.append(stat)
-                
+            # Skip the comparison, and loading the project's records, if
+            # the listing is the same as the last one processed.
+            digest = ListingDigest(listings[project])
+            if digest == self.db.GetListingDigest(project):
+                print "%s: No changes." % project
+                continue
+
+            # Sort to choose oldest submission first
+            submission_attr = sorted(listings[project],
+                                     key=lambda a: a.st_mtime)
             print "%s: Found %d submissions." % (project, len(submission_attr))
 
             for submission in submission_attr:
@@ -193,17 +1188,28 @@ class MonitorSSHLocation:
                 # Check for newer than previous
                 submit_time = datetime.fromtimestamp(int(submission.st_mtime))
                 if self.GetMostRecentlyModified(project, submission) < submit_time:
+                    # A queued older version is superseded however this
+                    # one is settled.
+                    self.DropQueued(project, submission.filename)
+
                     # Check for over file limit
                     if int(submission.st_size) > (project_cfg.size_limit*1e6):
                         self.UpdateDatabase(project, submission, 'file_too_large')
                         action = {'submission': submission, 'project': project}
                         data = self.project_data[project][submission.filename]
                         self.SendFailureEmail(action, data, append_log=False)
-                    else:
-                        self.AddToActionQueue(project_cfg, submission)
+                    elif not self.Admit(project_cfg, submission):
+                        pass # rejected without queueing
+                    elif not self.UseCachedResult(project_cfg, submission):
+                        new_actions.append(
+                            self.AddToActionQueue(project_cfg, submission))
 
                 # Otherwise, do nothing.
 
+            self.db.SetListingDigest(project, digest)
+
+        return new_actions
+
     def GetMostRecentlyModified(self, project, submission):
         # If a new submission, beginning of time
         if not self.project_data[project].has_key(submission.filename):
@@ -213,7 +1219,7 @@ class MonitorSSHLocation:
         return datetime.fromtimestamp(
             int(float(self.project_data[project][submission.filename]['timestamp'])))
 
-    def UpdateDatabase(self, project, submission, status_str):
+    def UpdateDatabase(self, project, submission, status_str, usage=None):
         if not self.project_data[project].has_key(submission.filename):
             self.project_data[project][submission.filename] = {}
         
@@ -223,219 +1229,439 @@ class MonitorSSHLocation:
         data['status'] = status_str
         data['size'] = "%.4f" % (int(submission.st_size)/1e6)
         data['name'] = submission.filename;
+        if usage is not None:
+            data['cpu_time'] = "%.2f" % usage[0]
+            data['max_rss'] = str(usage[1])
+        self.db.Update(project, data)
 
-        self.UpdateWebsite()
+        self.renderer.MarkDirty(project, data)
+        self.UpdateWebsite(force=False)
 
-    def WriteDatabase(self):
+    def OpenDatabase(self):
+        if self.db is not None:
+            return
+        self.db = SubmissionDatabase('./db/' + self.config.username + '.sqlite')
+        self.renderer.db = self.db
+        self.project_data = ProjectRecords(self.db)
+        self.log_store = LogStore(self.db, './db/' + self.config.username + '.logs')
+
+        # Import the CSV databases written by older versions of the monitor.
         for project in self.config.projects:
-            db = self.project_data[project.name]
-            dbfile = file('./db/' + '.'.join([self.config.username, project.name]),'w')
-            print "Updating database: %s" % dbfile.name
-
-            for submit_key in db.keys():
-                rec = db[submit_key]
-                row = []
-                for key in self.db_keys:
-                    row.append(rec[key])
-
-                dbfile.write(','.join(row) + '\n')
-            dbfile.close()
+            filename = './db/' + '.'.join([self.config.username, project.name])
+            if os.path.exists(filename) and not self.db.HasProject(project.name):
+                print "Importing database: %s" % filename
+                self.db.ImportCSV(project.name, filename)
+
+        # Grade again whatever an earlier run left queued or running.
+        for (project, count) in self.db.Recover().iteritems():
+            print "%s: requeueing %d interrupted submissions" % (project, count)
+            self.renderer.MarkDirty(project)
+
+    @TimedPhase
+    def WriteDatabase(self):
+        # Every update is already committed; fold the WAL back into the
+        # main database file.
+        print "Checkpointing database: %s" % self.db.filename
+        self.db.Checkpoint()
             
+    @TimedPhase
     def LoadDatabase(self):
+        # Only the status summary is read here; a project's records are
+        # loaded when its submissions have changed or its page is rendered.
+        self.OpenDatabase()
         for project in self.config.projects:
-            filename = './db/' + '.'.join([self.config.username, project.name])
-            if os.path.exists(filename):
-                dbfile = file(filename,'r')
-                print "Reading database: %s" % dbfile.name
-                db = self.project_data[project.name]
-                db.clear()
-                reader = csv.reader(dbfile, delimiter=',')
-                for row in reader:
-                    rec = {}
-                    for i in range(len(self.db_keys)):
-                        rec[self.db_keys[i]] = row[i]
-                        
-                    db[rec['name']] = rec
-                    print rec
-        
+            counts = self.db.CountStatus(project.name)
+            print "Database %s (%s): %d submissions" % (
+                self.db.filename, project.name, sum(counts.values()))
+
         self.UpdateWebsite()
 
+    def GetLogFiles(self, project, filename):
+        return ('%s/stdout.%s.%s' % (self.config.log_dir, project, filename),
+                '%s/stderr.%s.%s' % (self.config.log_dir, project, filename))
+
+    def GetActionVersion(self, executable):
+        """Returns a hash of the action script, recomputed whenever the
+        script's mtime changes."""
+        try:
+            mtime = os.stat(executable).st_mtime
+        except OSError:
+            return executable # not a file, e.g. a command on the PATH
+        cached = self.action_versions.get(executable)
+        if cached is None or cached[0] != mtime:
+            cached = (mtime, HashFile(executable))
+            self.action_versions[executable] = cached
+        return cached[1]
+
+    def Admit(self, project_cfg, submission):
+        """Runs the project's admission checks on a submission. If one
+        fails, marks the submission rejected, mails the reason and returns
+        False."""
+        if len(project_cfg.admission) == 0 or not self.config.is_local:
+            return True
+        path = '/'.join([self.config.target_dir, project_cfg.name,
+                         submission.filename])
+        candidate = Candidate(path, SubmissionUser(submission.filename),
+                              self.extract_cache)
+        try:
+            for check in project_cfg.admission:
+                check.Check(candidate)
+        except Rejected as err:
+            print "%s: rejected %s: %s" % (project_cfg.name, submission.filename,
+                                           str(err))
+            self.UpdateDatabase(project_cfg.name, submission, 'rejected')
+            action = {'submission': submission, 'project': project_cfg.name}
+            data = self.project_data[project_cfg.name][submission.filename]
+            self.SendFailureEmail(action, data, append_log=False,
+                                  reason=str(err))
+            return False
+        return True
+
+    def UseCachedResult(self, project_cfg, submission):
+        """Marks a submission completed without running its action if the
+        same file was already completed byte-identical with the same version
+        of the action. Other submitters' identical files are always graded,
+        since actions act on behalf of the submitter. Returns True if it
+        did."""
+        if not project_cfg.result_cache or not self.config.is_local:
+            return False
+        path = '/'.join([self.config.target_dir, project_cfg.name,
+                         submission.filename])
+        try:
+            submission.content_hash = HashFile(path)
+        except IOError as err:
+            print "Unable to hash %s: %s" % (path, str(err))
+            return False
+        version = self.GetActionVersion(project_cfg.action)
+        result = self.db.LookupResult(project_cfg.name, submission.filename,
+                                      version, submission.content_hash)
+        if result is None:
+            return False
+
+        print "%s: %s is identical to its graded version, reusing its result" % (
+            project_cfg.name, submission.filename)
+        (status, cached_stdout, cached_stderr) = result
+        for (stream, extent, path) in zip(
+                ['stdout', 'stderr'], [cached_stdout, cached_stderr],
+                self.GetLogFiles(project_cfg.name, submission.filename)):
+            self.log_store.Link(path, project_cfg.name, submission.filename,
+                                stream, extent)
+        self.UpdateDatabase(project_cfg.name, submission, status)
+        return True
+
+    def DropQueued(self, project, filename):
+        """Removes a queued action for (project, filename), and its
+        download, if there is one."""
+        queued = self.action_queue.Remove(project, filename)
+        if queued is not None and 'staged' in queued:
+            self.prefetcher.Discard(queued['staged'])
+
     def AddToActionQueue(self, project_cfg, submission):
         self.UpdateDatabase(project_cfg.name, submission, 'queued');
-        self.action_queue.append({
-                'executable': project_cfg.action,
-                'project': project_cfg.name, 
-                'submission': submission,
-                'timeout': project_cfg.time_limit})
-
-    def UpdateWebsite(self): 
-        
-        webroot = self.config.website_path
-        index_fp = file(webroot + "/index.html", "w");
-        project_fp = {}
-        for project in self.config.projects:
-            project_fp[project.name] = file(webroot + "/" + project.name + 
-                                            ".html", "w")
-        header_html = file(self.config.website_header, "r").read()
-        footer_html = file(self.config.website_footer, "r").read()
-        title_html = PAGE_TITLE_HTML.format(username=self.config.username,
-                                            version=VERSION,
-                                            updated=str(datetime.now()))
-        
-        # Update master index page.
-        index_fp.write(header_html + title_html + PROJECT_TABLE_HTML)
-        index_fp.write("<h2>Project Overviews</h2>")
-        for project in self.config.projects:
-            data = sorted(self.project_data[project.name].values(),
-                    key=lambda x: x['name']) # Sort by name
-            num_queued = len(
-                [a for a in data if a['status'] == 'queued'])
-            num_completed = len(
-                [a for a in data if a['status'] == 'completed'])
-            num_running = len(
-                [a for a in data if a['status'] == 'running'])
-            num_failed = len(
-                [a for a in data if a['status'].startswith('failed') or 
-                 a['status'] == 'killed' or a['status'] == 'file_too_large'])
-
-            num_submissions = len(self.project_data[project.name].keys())
-            index_fp.write(PROJECT_ROW_HTML.format(
-                    name=project.name, num_submissions=num_submissions,
-                    num_queued=num_queued, num_completed=num_completed, 
-                    num_running=num_running, num_failed=num_failed))
-
-            # Update project website.
-            fp = project_fp[project.name]
-            fp.write(header_html + title_html)
-            fp.write("<p><a href='index.html'>Back to Overview</a></p>")
-            fp.write("<h2>Project Submissions: %s</h2>\n" % project.name)
-            fp.write(SUBMISSION_TABLE_HTML)
-            for row in data:
-                fp.write(SUBMISSION_ROW_HTML.format(
-                        name=row['name'],
-                        size=row['size'] + ' MB', 
-                        submitted=str(
-                            datetime.fromtimestamp(float(row['timestamp']))),
-                        status=row['status'] + ' (' + 
-                        str(datetime.fromtimestamp(float(row['updated']))) + ')'))
-            fp.write('\n</table>\n\n' + footer_html)
-            fp.close()
+        if self.extract_cache is not None and self.config.is_local:
+            path = '/'.join([self.config.target_dir, project_cfg.name,
+                             submission.filename])
+            try:
+                self.extract_cache.Extract(path)
+            except (ArchiveError, IOError, OSError) as err:
+                print "Not extracting %s: %s" % (path, str(err))
+        action = {'executable': project_cfg.action,
+                  'project': project_cfg.name, 
+                  'submission': submission,
+                  'timeout': project_cfg.time_limit,
+                  'max_concurrency': project_cfg.max_concurrency,
+                  'priority': project_cfg.priority,
+                  'cpu_limit': project_cfg.cpu_limit,
+                  'memory_limit': project_cfg.memory_limit,
+                  'output_limit': project_cfg.output_limit,
+                  'log_limit': project_cfg.log_limit}
+        self.DropQueued(project_cfg.name, submission.filename)
+        if self.prefetcher is not None:
+            action['staged'] = self.prefetcher.Add(project_cfg.name, submission)
+        self.action_queue.Add(action)
+        return action
 
-        index_fp.write("\n</table>\n\n" + footer_html)
-        index_fp.close()
+    def UpdateWebsite(self, force=True):
+        # Only count calls that actually rewrote pages.
+        start = time.time()
+        if self.renderer.Render(self.project_data, force):
+            self.metrics.RecordPhase('UpdateWebsite', time.time() - start)
 
     def GetEmail(self, action):
-        filename = action['submission'].filename
-        if filename.endswith('.Z'):
-            username = filename[:-2]
-        else:
-            username = filename
-            
+        username = SubmissionUser(action['submission'].filename)
         email = username + "@seas.upenn.edu"
         return email
 
-    def SendFailureEmail(self, action, data, append_log=True):
+    def SendFailureEmail(self, action, data, append_log=True, reason=None):
         email = self.GetEmail(action)
 
         filename = action['submission'].filename
         txtstr = "Dear %s," % email
         txtstr += "Your submission to project %s has failed to execute.\n" % action['project']
-        txtstr += "The reason: %s\n" % data['status'] 
+        txtstr += "The reason: %s\n" % (reason or data['status'])
         txtstr += "Please forward this email to the TA if you don't understand the problem.\n"
         txtstr += "\n---------------- DATABASE ENTRY: \n"
         txtstr += str(data)
 
         if append_log:
+            max_bytes = self.config.email_log_bytes
             txtstr += "\n---------------- STDOUT: \n"
-            txtstr += ''.join(file(action['stdout'], 'r').readlines())
+            txtstr += self.log_store.ReadExcerpt(action['stdout'], max_bytes)
             txtstr += "\n---------------- STDERR: \n"
-            txtstr += ''.join(file(action['stderr'], 'r').readlines())
+            txtstr += self.log_store.ReadExcerpt(action['stderr'], max_bytes)
 
         self.SendEmail(email, "Submission Failure", txtstr)
 
-    def ExecuteActions(self):
-        print "%d actions remain in queue." % len(self.action_queue)
-
+    def SendReceivedEmails(self, actions):
         # Send email notification that action has been picked up.
-        for i in range(0, len(self.action_queue)):
-            action = self.action_queue[i]
+        for action in actions:
             email = self.GetEmail(action)
+            ahead = self.action_queue.index(action) + len(self.running)
             txtstr = "Dear %s," % email
             txtstr += "Your submission to project %s has been received.\n" % action['project']
-            txtstr += "There are %d submissions ahead of you in line.\n" % (len(self.action_queue)-i-1)
+            txtstr += "There are %d submissions ahead of you in line.\n" % ahead
             self.SendEmail(email, "Submission Received", txtstr)
 
-        for action in self.action_queue:
-            project = action['project']
-            filename = action['submission'].filename
-            args = [action['executable'], project, filename]
-            print "Executing action: %s" % ' '.join(args)
+    def CanStartAction(self, action):
+        # Skip projects that are already at their concurrency limit and
+        # submissions that are still being graded from an earlier version.
+        limit = action['max_concurrency']
+        active = self.running.values()
+        num_project = len([a for a in active
+                           if a['project'] == action['project']])
+        busy = len([a for a in active
+                    if a['project'] == action['project'] and
+                    a['submission'].filename == action['submission'].filename])
+        return not ((limit > 0 and num_project >= limit) or busy > 0)
+
+    def StartActions(self, done_queue):
+        # Fill free worker slots in the scheduler's fair-share order.
+        while len(self.running) < self.config.max_workers:
+            action = self.action_queue.Pop(self.CanStartAction)
+            if action is None:
+                break
+            slot = self.StartAction(action, done_queue)
+            self.running[slot] = action
+
+    @TimedPhase
+    def ExecuteActions(self):
+        print "%d actions remain in queue." % len(self.action_queue)
+        self.SendReceivedEmails(self.action_queue)
+
+        done_queue = Queue.Queue()
+        while len(self.action_queue) > 0 or len(self.running) > 0:
+            self.StartActions(done_queue)
+            self.UpdateWebsite(force=False)
 
-            action['stdout'] = '%s/stdout.%s.%s' % (self.config.log_dir, project, filename)
-            action['stderr'] = '%s/stderr.%s.%s' % (self.config.log_dir, project, filename)
+            # Block until any running action finishes, or dirty pages are
+            # due.
             try:
-                os.remove(action['stdout'])
-                os.remove(action['stderr'])
-                print "removed log %s" % action['stdout']
-                print "removed log %s" % action['stderr']
-            except OSError as err:
-                print "could not remove logs: %s" % str(err)
-
-            stdout = file(action['stdout'], 'w')
-            stderr = file(action['stderr'], 'w')
-
-            start_time = time.time()
-            self.UpdateDatabase(project, action['submission'], 'running');
-            p = subprocess.Popen(args, stdout=stdout, stderr=stderr)
-
-            kill = False
-            while not kill and (p.poll() == None):
-                # Check very 1s if process is still running.
-                elapsed = (time.time() - start_time)
-                if  elapsed > action['timeout']:
-                    kill = True
-                    print "Process is overtime after %.2f secs" % elapsed
-                else:
-                    time.sleep(0.1)
+                slot = done_queue.get(True, self.renderer.RenderDelay())
+            except Queue.Empty:
+                continue
+            del self.running[slot]
+            self.FinishAction(slot)
+            self.metrics.Write(self)
 
-            if kill:
-                p.kill()
-                print "Killed process: %d" % p.pid
-                os.system("killall MATLAB");
-                self.UpdateDatabase(project, action['submission'], 'killed')
+    def RunDaemon(self):
+        """Runs forever, scanning for submissions whenever the watcher
+        reports a change and grading them as worker slots free up."""
+        events = Queue.Queue()
+        watcher = SubmissionWatcher(self.config, events)
+        watcher.start()
+
+        self.LoadDatabase()
+        while True:
+            try:
+                new_actions = self.GetActionQueue(watcher.TakeChanged())
+            except ScanErrors() as err:
+                # Retried on the next trigger; running actions go on.
+                print "Unable to scan %s: %s" % (self.config.target_dir,
+                                                 str(err))
+                watcher.ScanFailed()
             else:
-                print "Action returned with code: %d" % p.returncode
-                if p.returncode == 0:
-                    self.UpdateDatabase(project, action['submission'], 'completed')
+                if len(new_actions) > 0:
+                    print "%d actions remain in queue." % len(self.action_queue)
+                    self.SendReceivedEmails(new_actions)
+                    watcher.Reset()
                 else:
-                    self.UpdateDatabase(project, action['submission'], 
-                                        'failed(%d)' % p.returncode)
+                    watcher.Backoff()
+            self.metrics.Write(self)
 
-            stdout.close()
-            stderr.close()
-            data = self.project_data[project][action['submission'].filename]
-            if not data['status'] == 'completed':
-                self.SendFailureEmail(action, data, 
-                                      append_log=data['status'] != 'killed')
+            self.StartActions(events)
 
+            # Wait for either a finished action or a filesystem change. Keep
+            # handling finished actions until the watcher asks for a scan,
+            # and render dirty pages when they are due.
+            while True:
+                self.UpdateWebsite(force=False)
+                delay = self.renderer.RenderDelay()
+                rescan = delay is None or delay >= self.config.poll_max
+                if rescan:
+                    delay = self.config.poll_max
+                try:
+                    item = events.get(True, delay)
+                except Queue.Empty:
+                    if rescan:
+                        break
+                    continue
+                if item is not None:
+                    del self.running[item]
+                    self.FinishAction(item)
+                    self.metrics.Write(self)
+                    self.StartActions(events)
+                else:
+                    break
+
+    def StartAction(self, action, done_queue):
+        project = action['project']
+        filename = action['submission'].filename
+        args = [action['executable'], project, filename]
+        print "Executing action: %s" % ' '.join(args)
+
+        (action['stdout'], action['stderr']) = self.GetLogFiles(project, filename)
+        try:
+            os.remove(action['stdout'])
+            os.remove(action['stderr'])
+            print "removed log %s" % action['stdout']
+            print "removed log %s" % action['stderr']
+        except OSError as err:
+            print "could not remove logs: %s" % str(err)
+
+        self.UpdateDatabase(project, action['submission'], 'running');
+        if self.work_queue is not None:
+            return self.PublishAction(action, args, done_queue)
+        if project in self.pools:
+            return self.RunOnPool(action, done_queue)
+
+        stdout = file(action['stdout'], 'w')
+        stderr = file(action['stderr'], 'w')
+        slot = ActionSlot(action, args, stdout, stderr, done_queue)
+        slot.start()
+        return slot
+
+    def PublishAction(self, action, args, done_queue):
+        """Hands an action to the grading workers. Returns the RemoteJob
+        that the collector puts on done_queue once a worker reports."""
+        if self.collector is None:
+            self.collector = QueueCollector(self.work_queue, done_queue,
+                                            self.config.poll_min)
+            self.collector.start()
+        self.job_count += 1
+        # Ids sort in publishing order, so workers claim jobs FIFO.
+        job = RemoteJob(action, "%017.6f-%06d" % (time.time(), self.job_count))
+        self.collector.Add(job)
+        self.work_queue.Publish({'id': job.job_id, 'args': args,
+                                 'stdout': action['stdout'],
+                                 'stderr': action['stderr'],
+                                 'timeout': action['timeout'],
+                                 'cpu_limit': action['cpu_limit'],
+                                 'memory_limit': action['memory_limit'],
+                                 'output_limit': action['output_limit'],
+                                 'log_limit': action['log_limit']})
+        print "Published job %s" % job.job_id
+        return job
+
+    def RunOnPool(self, action, done_queue):
+        """Sends an action to one of its project's persistent workers.
+        Returns the WarmJob, which is put on done_queue once answered."""
+        # The worker writes the logs itself; they must exist to be archived.
+        file(action['stdout'], 'w').close()
+        file(action['stderr'], 'w').close()
+        self.job_count += 1
+        request = {'id': self.job_count, 'project': action['project'],
+                   'filename': action['submission'].filename,
+                   'stdout': os.path.abspath(action['stdout']),
+                   'stderr': os.path.abspath(action['stderr'])}
+        pool = self.pools[action['project']]
+        return pool.Run(action, request, done_queue)
+
+    def ArchiveLogs(self, action):
+        """Moves a finished action's logs into the compressed log store."""
+        for (stream, path) in [('stdout', action['stdout']),
+                               ('stderr', action['stderr'])]:
+            try:
+                self.log_store.Add(path, action['project'],
+                                   action['submission'].filename, stream)
+            except (IOError, OSError) as err:
+                print "Unable to archive log %s: %s" % (path, str(err))
+
+    def StoreResult(self, action):
+        """Keeps the archived logs of a completed action for reuse by
+        byte-identical submissions."""
+        content_hash = getattr(action['submission'], 'content_hash', None)
+        if content_hash is None:
+            return
+        logs = [self.db.GetLog(action[stream]) for stream in ['stdout', 'stderr']]
+        if None in logs:
+            return # not archived
+        self.db.StoreResult(action['project'], action['submission'].filename,
+                            self.GetActionVersion(action['executable']),
+                            content_hash, 'completed', logs[0], logs[1])
+
+    def FinishAction(self, slot):
+        action = slot.action
+        project = action['project']
+        self.metrics.RecordAction(project, slot.elapsed)
+        usage = None
+        if slot.cpu_time is not None:
+            usage = (slot.cpu_time, slot.max_rss)
+            print "Action used %.2f CPU secs, %d KB peak RSS" % usage
+        if slot.error is not None:
+            print "Unable to execute action: %s" % str(slot.error)
+            self.UpdateDatabase(project, action['submission'], 'failed(exec)')
+        elif slot.killed:
+            print "Killed action on %s" % action['submission'].filename
+            self.UpdateDatabase(project, action['submission'], 'killed', usage)
+        else:
+            print "Action returned with code: %d (%.2f secs)" % (
+                slot.returncode, slot.elapsed)
+            if slot.returncode == 0:
+                self.UpdateDatabase(project, action['submission'], 'completed',
+                                    usage)
+            else:
+                self.UpdateDatabase(project, action['submission'], 
+                                    'failed(%d)' % slot.returncode, usage)
+
+        self.ArchiveLogs(action)
+        if slot.error is None and not slot.killed and slot.returncode == 0:
+            self.StoreResult(action)
+        if 'staged' in action:
+            self.prefetcher.Discard(action['staged'])
+        data = self.project_data[project][action['submission'].filename]
+        if not data['status'] == 'completed':
+            self.SendFailureEmail(action, data, 
+                                  append_log=data['status'] != 'killed')
 
-            
 
 if __name__ == '__main__':
     if len(sys.argv) == 1:
-        print "usage: %s <config.ini>" % sys.argv[0]
+        print "usage: %s [--daemon] <config.ini>" % sys.argv[0]
+    elif sys.argv[1] == '--daemon':
+        monitor = MonitorSSHLocation(MonitorConfig(sys.argv[2]))
+        try:
+            monitor.RunDaemon()
+        except KeyboardInterrupt:
+            monitor.UpdateWebsite()
+            monitor.WriteDatabase()
+            monitor.ClosePools()
+            monitor.notifier.Close()
     else:
         monitor = MonitorSSHLocation(MonitorConfig(sys.argv[1]))
         monitor.LoadDatabase()
         monitor.GetActionQueue()
         monitor.ExecuteActions()
+        monitor.UpdateWebsite()
         monitor.WriteDatabase()
+        monitor.metrics.Write(monitor)
+        monitor.ClosePools()
+        monitor.notifier.Close()
 
 
 # Monitor "submit" directory -- monitoring multiple projects.
 # Check last updated time of each file in each directory.
 # If it's a new file, run the script and store in the database.
-# Database format: csv file.
+# Database format: sqlite file (./db/<username>.sqlite).
 # Each project is a subdirectory of submit.
 # Each project can have an associated script to be run for each user.
 # This is then output to
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+#
+# Background email delivery for the submission monitor.
+#
+# Messages are queued by Send() and delivered by a single sender thread,
+# so grading never waits on mail. Messages to the same recipient that are
+# queued within BATCH_WINDOW seconds of each other are merged into one
+# email. Mail goes over one reused SMTP connection when smtp_host is
+# configured, and through the mail(1) command otherwise.
+
+import sys, time, threading, Queue, subprocess, smtplib, socket
+from email.mime.text import MIMEText
+
+# Seconds to wait after the first queued message for more to merge with it.
+BATCH_WINDOW = 1.0
+
+# Seconds an idle SMTP connection is kept open.
+SMTP_IDLE_TIMEOUT = 30
+
+class Notifier(threading.Thread):
+    def __init__(self, config):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.config = config
+        self.queue = Queue.Queue()
+        self.smtp = None
+        self.start()
+
+    def Send(self, rcpt, subj, txt):
+        self.queue.put((rcpt, subj, txt))
+
+    def Close(self):
+        """Delivers everything still queued and stops the sender."""
+        self.queue.put(None)
+        self.join()
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            try:
+                first = self.queue.get(True, SMTP_IDLE_TIMEOUT)
+            except Queue.Empty:
+                self.Disconnect()
+                continue
+            if first is None:
+                break
+
+            # Collect whatever else arrives within the batch window.
+            batch = [first]
+            deadline = time.time() + BATCH_WINDOW
+            while True:
+                try:
+                    msg = self.queue.get(True, max(0, deadline - time.time()))
+                except Queue.Empty:
+                    break
+                if msg is None:
+                    stopping = True
+                    break
+                batch.append(msg)
+
+            for (rcpt, subj, txt) in self.Merge(batch):
+                try:
+                    self.Deliver(rcpt, subj, txt)
+                except Exception as err:
+                    print "Unable to send email to %s: %s" % (rcpt, str(err))
+                    self.Disconnect()
+        self.Disconnect()
+
+    def Merge(self, batch):
+        """Merges queued messages by recipient, keeping first-seen order."""
+        order = []
+        merged = {}
+        for (rcpt, subj, txt) in batch:
+            if rcpt not in merged:
+                order.append(rcpt)
+                merged[rcpt] = []
+            merged[rcpt].append((subj, txt))
+
+        messages = []
+        for rcpt in order:
+            parts = merged[rcpt]
+            if len(parts) == 1:
+                messages.append((rcpt, parts[0][0], parts[0][1]))
+                continue
+            subjects = set([subj for (subj, txt) in parts])
+            if len(subjects) == 1:
+                subj = parts[0][0]
+            else:
+                subj = "%d notifications" % len(parts)
+            txt = "\n\n".join(["---------------- %s\n%s" % (s, t)
+                               for (s, t) in parts])
+            messages.append((rcpt, subj, txt))
+        return messages
+
+    def Deliver(self, rcpt, subj, txt):
+        subject = "%s: %s" % (self.config.username, subj)
+        if self.config.smtp_host is None:
+            p = subprocess.Popen(['mail', '-c', '', '-s', subject, rcpt],
+                                 stdin=subprocess.PIPE)
+            p.communicate(txt)
+            return
+
+        msg = MIMEText(txt)
+        msg['Subject'] = subject
+        msg['From'] = self.config.mail_from
+        msg['To'] = rcpt
+        if self.smtp is None:
+            self.smtp = smtplib.SMTP(self.config.smtp_host,
+                                     self.config.smtp_port)
+        self.smtp.sendmail(self.config.mail_from, [rcpt], msg.as_string())
+
+    def Disconnect(self):
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except (smtplib.SMTPException, socket.error):
+                pass
+            self.smtp = None
+
+if __name__ == '__main__':
+    # Sends a test message: notify.py <smtp_host> <smtp_port> <rcpt>
+    if len(sys.argv) != 4:
+        print "usage: %s <smtp_host> <smtp_port> <rcpt>" % sys.argv[0]
+        sys.exit(1)
+
+    class TestConfig:
+        username = 'notify-test'
+        smtp_host = sys.argv[1]
+        smtp_port = int(sys.argv[2])
+        mail_from = 'notify-test'
+
+    notifier = Notifier(TestConfig())
+    notifier.Send(sys.argv[3], "Test", "First message.\n")
+    notifier.Send(sys.argv[3], "Test", "Second message.\n")
+    notifier.Close()
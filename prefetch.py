@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+#
+# Prefetching of remote submissions into a local staging directory.
+#
+# With is_local = false and staging_dir set, each submission is queued for
+# download as soon as its action is queued, so transfers run in parallel
+# with grading and an action usually finds its input already local. A
+# submission is fetched to
+#
+#   <staging_dir>/<project>/<filename>/<size>-<mtime>/<filename>
+#
+# through a .part file that is resumed after a dropped connection and only
+# renamed into place once its size matches the listing. The action is then
+# started with the local path in $SUBMISSION_PATH; if the transfer failed
+# the variable is not set and the action fetches the file itself, as
+# before. The staged copy is removed once the action has finished.
+
+import os, time, shutil, threading, Queue
+
+# Environment variable holding the local copy of the submission.
+STAGED_ENV = 'SUBMISSION_PATH'
+
+CHUNK_SIZE = 1 << 20
+
+# Attempts at a transfer before the action is left to fetch it itself.
+FETCH_ATTEMPTS = 3
+
+class PrefetchError(Exception):
+    pass
+
+def RemoveStaged(staged):
+    version_dir = os.path.dirname(staged.path)
+    shutil.rmtree(version_dir, ignore_errors=True)
+    try:
+        os.rmdir(os.path.dirname(version_dir))
+    except OSError:
+        pass # other versions staged
+
+class StagedFile:
+    """A submission being staged. Wait() returns the local path once it
+    is there, or None if it could not be fetched."""
+    def __init__(self, project, submission, path):
+        self.project = project
+        self.submission = submission
+        self.path = path
+        self.done = threading.Event()
+        self.ok = False
+        self.discarded = False
+
+    def Wait(self):
+        self.done.wait()
+        if self.ok:
+            return self.path
+        return None
+
+class Prefetcher:
+    """Downloads submissions over its own SFTP connection with a pool of
+    threads, oldest first."""
+    def __init__(self, connection, target_dir, staging_dir, workers):
+        self.connection = connection
+        self.target_dir = target_dir
+        self.staging_dir = staging_dir
+        self.lock = threading.Lock()
+        self.pending = Queue.Queue()
+        for i in range(workers):
+            thread = threading.Thread(target=self.Run)
+            thread.daemon = True
+            thread.start()
+
+    def Add(self, project, submission):
+        filename = submission.filename
+        path = os.path.join(self.staging_dir, project, filename, "%d-%d" % (
+                int(submission.st_size), int(submission.st_mtime)), filename)
+        staged = StagedFile(project, submission, path)
+        self.pending.put(staged)
+        return staged
+
+    def Discard(self, staged):
+        """Removes the staged copy, now or once its transfer ends."""
+        with self.lock:
+            staged.discarded = True
+            if not staged.done.is_set():
+                return
+        RemoveStaged(staged)
+
+    def GetChannel(self):
+        with self.lock:
+            self.connection.Connect()
+            return self.connection.GetChannel()
+
+    def DropChannel(self, sftp):
+        try:
+            sftp.close()
+        except Exception:
+            pass
+        with self.lock:
+            if not self.connection.IsActive():
+                self.connection.Close()
+
+    def Fetch(self, staged):
+        if os.path.exists(staged.path):
+            return
+        remote_path = '/'.join([self.target_dir, staged.project,
+                                staged.submission.filename])
+        size = int(staged.submission.st_size)
+        part = staged.path + '.part'
+        if not os.path.isdir(os.path.dirname(part)):
+            os.makedirs(os.path.dirname(part))
+        offset = 0
+        if os.path.exists(part):
+            offset = os.path.getsize(part)
+            if offset > size:
+                os.remove(part)
+                offset = 0
+
+        start = time.time()
+        resumed = offset
+        sftp = self.GetChannel()
+        try:
+            remote = sftp.open(remote_path, 'rb')
+            remote.seek(offset)
+            remote.prefetch()
+            local = file(part, 'ab')
+            while True:
+                data = remote.read(CHUNK_SIZE)
+                if not data:
+                    break
+                offset += len(data)
+                if offset > size:
+                    break
+                local.write(data)
+            local.close()
+            remote.close()
+        except Exception:
+            self.DropChannel(sftp)
+            raise
+        self.connection.ReleaseChannel(sftp)
+
+        if offset != size:
+            # Replaced since it was listed; the next scan will requeue it.
+            os.remove(part)
+            raise PrefetchError("%s is %d bytes, not %d" % (remote_path,
+                                                            offset, size))
+        mtime = int(staged.submission.st_mtime)
+        os.utime(part, (mtime, mtime))
+        os.rename(part, staged.path)
+        print "Staged %s (%d bytes, %d resumed, %.2f secs)" % (
+            remote_path, size, resumed, time.time() - start)
+
+    def Run(self):
+        while True:
+            staged = self.pending.get()
+            for attempt in range(FETCH_ATTEMPTS):
+                if staged.discarded:
+                    break
+                try:
+                    self.Fetch(staged)
+                    staged.ok = True
+                    break
+                except PrefetchError as err:
+                    print "Unable to stage submission: %s" % str(err)
+                    break
+                except Exception as err:
+                    print "Unable to stage %s/%s (attempt %d): %s" % (
+                        staged.project, staged.submission.filename,
+                        attempt + 1, str(err))
+            with self.lock:
+                staged.done.set()
+                discarded = staged.discarded
+            if discarded:
+                RemoveStaged(staged)
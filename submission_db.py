@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+#
+# SQLite storage for the submission monitor's database.
+#
+# Every status change is written as a single-row upsert in its own
+# transaction, so a crash loses at most the change in progress. The
+# database runs in WAL mode, so readers (the website, check_failed_logs.sh)
+# never block the monitor.
+#
+# Per-project counts of submissions by status are kept up to date in the
+# status_counts table, and the digest of each project's last processed
+# directory listing in listings, so the monitor can start and render its
+# index without reading every record.
+
+import sys, csv, os
+import sqlite3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS submissions (
+  project TEXT NOT NULL,
+  name TEXT NOT NULL,
+  size TEXT NOT NULL,
+  updated TEXT NOT NULL,
+  timestamp TEXT NOT NULL,
+  status TEXT NOT NULL,
+  cpu_time TEXT,
+  max_rss TEXT,
+  PRIMARY KEY (project, name)
+);
+CREATE INDEX IF NOT EXISTS submissions_status ON submissions (project, status);
+CREATE TABLE IF NOT EXISTS results (
+  project TEXT NOT NULL,
+  name TEXT NOT NULL,
+  action_version TEXT NOT NULL,
+  content_hash TEXT NOT NULL,
+  status TEXT NOT NULL,
+  stdout_offset INTEGER NOT NULL,
+  stdout_length INTEGER NOT NULL,
+  stdout_size INTEGER NOT NULL,
+  stderr_offset INTEGER NOT NULL,
+  stderr_length INTEGER NOT NULL,
+  stderr_size INTEGER NOT NULL,
+  PRIMARY KEY (project, name, action_version, content_hash)
+);
+CREATE TABLE IF NOT EXISTS logs (
+  path TEXT PRIMARY KEY,
+  project TEXT NOT NULL,
+  name TEXT NOT NULL,
+  stream TEXT NOT NULL,
+  offset INTEGER NOT NULL,
+  length INTEGER NOT NULL,
+  size INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS logs_submission ON logs (project, name);
+CREATE TABLE IF NOT EXISTS status_counts (
+  project TEXT NOT NULL,
+  status TEXT NOT NULL,
+  count INTEGER NOT NULL,
+  PRIMARY KEY (project, status)
+);
+CREATE TABLE IF NOT EXISTS listings (
+  project TEXT PRIMARY KEY,
+  digest TEXT NOT NULL
+);
+"""
+
+# Order of the columns in the old ./db/<user>.<project> CSV files.
+DB_KEYS = ['name', 'size', 'updated', 'timestamp', 'status']
+
+# Resource usage of the last run (CPU secs, peak RSS in KB), if any.
+USAGE_KEYS = ['cpu_time', 'max_rss']
+
+COLUMNS = ', '.join(DB_KEYS + USAGE_KEYS)
+
+class SubmissionDatabase:
+    def __init__(self, filename):
+        self.filename = filename
+        self.conn = sqlite3.connect(filename)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=FULL")
+        self.conn.executescript(SCHEMA)
+        # Databases created before resource usage was recorded.
+        columns = [row[1] for row in
+                   self.conn.execute("PRAGMA table_info(submissions)")]
+        for key in USAGE_KEYS:
+            if key not in columns:
+                self.conn.execute("ALTER TABLE submissions ADD COLUMN %s TEXT" % key)
+        # Databases whose cached results named log paths, which later runs
+        # of the same submission overwrite, or were shared between
+        # submitters; those results are dropped.
+        columns = [row[1] for row in
+                   self.conn.execute("PRAGMA table_info(results)")]
+        if 'name' not in columns:
+            self.conn.execute("DROP TABLE results")
+            self.conn.executescript(SCHEMA)
+        self.conn.commit()
+        # Databases created before the status summary was kept.
+        if (self.conn.execute("SELECT 1 FROM status_counts LIMIT 1").fetchone() is None and
+            self.conn.execute("SELECT 1 FROM submissions LIMIT 1").fetchone() is not None):
+            self.RebuildCounts()
+
+    def MakeRecord(self, row):
+        rec = dict(zip(DB_KEYS, [str(v) for v in row[:len(DB_KEYS)]]))
+        for (key, value) in zip(USAGE_KEYS, row[len(DB_KEYS):]):
+            if value is not None:
+                rec[key] = str(value)
+        return rec
+
+    def Load(self, project):
+        """Returns a dict of submission name -> record for project."""
+        db = {}
+        cursor = self.conn.execute(
+            "SELECT " + COLUMNS + " FROM submissions WHERE project = ?",
+            (project,))
+        for row in cursor:
+            rec = self.MakeRecord(row)
+            db[rec['name']] = rec
+        return db
+
+    def Get(self, project, name):
+        row = self.conn.execute(
+            "SELECT " + COLUMNS + " FROM submissions "
+            "WHERE project = ? AND name = ?", (project, name)).fetchone()
+        if row is None:
+            return None
+        return self.MakeRecord(row)
+
+    def AddCount(self, project, status, n):
+        self.conn.execute(
+            "INSERT OR IGNORE INTO status_counts (project, status, count) "
+            "VALUES (?, ?, 0)", (project, status))
+        self.conn.execute(
+            "UPDATE status_counts SET count = count + ? "
+            "WHERE project = ? AND status = ?", (n, project, status))
+
+    def RebuildCounts(self):
+        with self.conn:
+            self.conn.execute("DELETE FROM status_counts")
+            self.conn.execute(
+                "INSERT INTO status_counts (project, status, count) "
+                "SELECT project, status, COUNT(*) FROM submissions "
+                "GROUP BY project, status")
+
+    def Update(self, project, rec):
+        with self.conn:
+            row = self.conn.execute(
+                "SELECT status FROM submissions WHERE project = ? AND name = ?",
+                (project, rec['name'])).fetchone()
+            if row is not None:
+                self.AddCount(project, row[0], -1)
+            self.AddCount(project, rec['status'], 1)
+            self.conn.execute(
+                "INSERT OR REPLACE INTO submissions "
+                "(project, " + COLUMNS + ") VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (project, rec['name'], rec['size'], rec['updated'],
+                 rec['timestamp'], rec['status'], rec.get('cpu_time'),
+                 rec.get('max_rss')))
+
+    def Recover(self):
+        """Resets submissions left queued or running by a monitor that
+        stopped before grading them: marks them queued with a zero
+        timestamp, so the next scan queues them again, and forgets their
+        projects' listing digests. Returns a dict of project -> number of
+        submissions reset."""
+        recovered = {}
+        with self.conn:
+            for (project, status, n) in self.conn.execute(
+                    "SELECT project, status, COUNT(*) FROM submissions "
+                    "WHERE status IN ('queued', 'running') "
+                    "GROUP BY project, status").fetchall():
+                project = str(project)
+                self.AddCount(project, status, -n)
+                self.AddCount(project, 'queued', n)
+                recovered[project] = recovered.get(project, 0) + n
+            self.conn.execute(
+                "UPDATE submissions SET status = 'queued', timestamp = '0' "
+                "WHERE status IN ('queued', 'running')")
+            for project in recovered:
+                self.conn.execute("DELETE FROM listings WHERE project = ?",
+                                  (project,))
+        return recovered
+
+    def LookupResult(self, project, name, action_version, content_hash):
+        """Returns (status, stdout log, stderr log) of an earlier run of the
+        same action version on identical content submitted as name, or
+        None. Each log is the (offset, compressed length, size) of its
+        archived copy."""
+        row = self.conn.execute(
+            "SELECT status, stdout_offset, stdout_length, stdout_size, "
+            "stderr_offset, stderr_length, stderr_size FROM results "
+            "WHERE project = ? AND name = ? AND action_version = ? AND "
+            "content_hash = ?",
+            (project, name, action_version, content_hash)).fetchone()
+        if row is None:
+            return None
+        return (str(row[0]), tuple(row[1:4]), tuple(row[4:7]))
+
+    def StoreResult(self, project, name, action_version, content_hash, status,
+                    stdout, stderr):
+        """Records a run's status and the archived (offset, compressed
+        length, size) of its stdout and stderr logs."""
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO results (project, name, "
+                "action_version, content_hash, status, stdout_offset, "
+                "stdout_length, stdout_size, stderr_offset, stderr_length, "
+                "stderr_size) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (project, name, action_version, content_hash, status) +
+                tuple(stdout) + tuple(stderr))
+
+    def AddLog(self, path, project, name, stream, offset, length, size):
+        """Records where the archived copy of log file path is stored."""
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO logs (path, project, name, stream, "
+                "offset, length, size) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (path, project, name, stream, offset, length, size))
+
+    def GetLog(self, path):
+        """Returns (offset, compressed length, size) of an archived log, or
+        None."""
+        return self.conn.execute(
+            "SELECT offset, length, size FROM logs WHERE path = ?",
+            (path,)).fetchone()
+
+    def FindLogs(self, project, status_pattern, stream):
+        """Returns (name, path) of the archived stream logs of submissions
+        whose status matches a LIKE pattern."""
+        return [(str(row[0]), str(row[1])) for row in self.conn.execute(
+            "SELECT s.name, l.path FROM submissions s JOIN logs l "
+            "ON l.project = s.project AND l.name = s.name "
+            "WHERE s.project = ? AND s.status LIKE ? AND l.stream = ? "
+            "ORDER BY s.name", (project, status_pattern, stream))]
+
+    def LogExtents(self):
+        """Returns the distinct (offset, length) of all archived logs,
+        including those kept for cached results."""
+        return self.conn.execute(
+            "SELECT offset, length FROM logs UNION "
+            "SELECT stdout_offset, stdout_length FROM results UNION "
+            "SELECT stderr_offset, stderr_length FROM results "
+            "ORDER BY 1").fetchall()
+
+    def MoveLogs(self, offsets):
+        """Rewrites log offsets after compaction; offsets maps old -> new."""
+        with self.conn:
+            for (table, column) in [('logs', 'offset'),
+                                    ('results', 'stdout_offset'),
+                                    ('results', 'stderr_offset')]:
+                self.conn.execute("UPDATE %s SET %s = -%s - 1" % (
+                        table, column, column))
+                for (old, new) in offsets.iteritems():
+                    self.conn.execute(
+                        "UPDATE %s SET %s = ? WHERE %s = ?" % (
+                            table, column, column), (new, -old - 1))
+
+    def CountStatus(self, project):
+        """Returns a dict of status -> number of submissions."""
+        return dict(self.conn.execute(
+            "SELECT status, count FROM status_counts WHERE project = ? "
+            "AND count > 0", (project,)).fetchall())
+
+    def GetListingDigest(self, project):
+        row = self.conn.execute(
+            "SELECT digest FROM listings WHERE project = ?",
+            (project,)).fetchone()
+        if row is None:
+            return None
+        return str(row[0])
+
+    def SetListingDigest(self, project, digest):
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO listings (project, digest) VALUES (?, ?)",
+                (project, digest))
+
+    def Find(self, project, status_pattern):
+        """Returns names of submissions whose status matches a LIKE
+        pattern, e.g. 'failed%'."""
+        return [str(row[0]) for row in self.conn.execute(
+            "SELECT name FROM submissions WHERE project = ? AND status LIKE ? "
+            "ORDER BY name", (project, status_pattern))]
+
+    def HasProject(self, project):
+        return self.conn.execute(
+            "SELECT 1 FROM submissions WHERE project = ? LIMIT 1",
+            (project,)).fetchone() is not None
+
+    def ImportCSV(self, project, csv_filename):
+        """Imports an old ./db/<user>.<project> CSV file. Returns the number
+        of records imported."""
+        count = 0
+        with self.conn:
+            for row in csv.reader(file(csv_filename, 'r'), delimiter=','):
+                rec = dict(zip(DB_KEYS, row))
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO submissions "
+                    "(project, name, size, updated, timestamp, status) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (project, rec['name'], rec['size'], rec['updated'],
+                     rec['timestamp'], rec['status']))
+                count += 1
+        self.RebuildCounts()
+        return count
+
+    def Checkpoint(self):
+        self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def Close(self):
+        self.conn.close()
+
+class ProjectRecords(dict):
+    """Dict of project -> {submission name -> record} that reads each
+    project's records from db the first time they are used."""
+    def __init__(self, db):
+        dict.__init__(self)
+        self.db = db
+
+    def __missing__(self, project):
+        records = self.db.Load(project)
+        self[project] = records
+        return records
+
+if __name__ == '__main__':
+    if len(sys.argv) < 4:
+        print "usage: %s <db.sqlite> import <project> <csv_file>" % sys.argv[0]
+        print "       %s <db.sqlite> find <project> <status_pattern>" % sys.argv[0]
+        sys.exit(1)
+
+    db = SubmissionDatabase(sys.argv[1])
+    if sys.argv[2] == 'import' and len(sys.argv) == 5:
+        print "Imported %d records" % db.ImportCSV(sys.argv[3], sys.argv[4])
+    elif sys.argv[2] == 'find':
+        for name in db.Find(sys.argv[3], sys.argv[4]):
+            print name
+    else:
+        sys.stderr.write("error: unknown command %s\n" % sys.argv[2])
+        sys.exit(1)
+    db.Close()
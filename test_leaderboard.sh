@@ -11,7 +11,10 @@ mkdir -p $rundir || exit 1
 cd $rundir  || exit 1
 pwd
 
-python ~/class-monitor/update_leaderboard.py ~/fall2011-projects/db/project_groups.db ~/fall2011-projects/db/leaderboard.db ~/fall2011-projects/db/answers.txt ~/submit/$project/$user > result.txt || exit 1
+# Use the monitor's local copy of the submission if it staged one.
+submission=${SUBMISSION_PATH:-~/submit/$project/$user}
+
+python ~/class-monitor/update_leaderboard.py ~/fall2011-projects/db/project_groups.db ~/fall2011-projects/db/leaderboard.db ~/fall2011-projects/db/answers.txt $submission > result.txt || exit 1
 
 # Get email 
 if [[ $user == *\.Z ]]
@@ -0,0 +1,25 @@
+#!/usr/bin/env python
+#
+# Example action for a project with persistent_workers (see warm_pool.py):
+# does what test_action.bash does, but is started once and then reads jobs
+# from stdin, one line of JSON each.
+
+import sys, json, time
+
+if len(sys.argv) != 3 or sys.argv[1] != '--persistent':
+    print "usage: %s --persistent <workspace>" % sys.argv[0]
+    sys.exit(1)
+
+# Expensive setup (starting MATLAB, loading answers) would go here.
+
+for line in iter(sys.stdin.readline, ''):
+    job = json.loads(line)
+    out = file(job['stdout'], 'w')
+    out.write("%s %s\n" % (job['project'], job['filename']))
+    out.write("Sleeping...\n")
+    out.flush()
+    time.sleep(5)
+    out.write("Done.\n")
+    out.close()
+    sys.stdout.write(json.dumps({'id': job['id'], 'returncode': 0}) + '\n')
+    sys.stdout.flush()
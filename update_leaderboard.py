@@ -8,7 +8,12 @@
 
 from datetime import *
 import sys, csv, time, subprocess, os
-import tarfile, math, pickle
+import tarfile, math, itertools, json
+import multiprocessing
+import numpy as np
+from extract_cache import OpenMember, ArchiveError
+from group_store import GroupStore
+from file_util import IsSQLite, ConnectShared, ConvertPickle, WriteFileAtomic
 
 VERSION = "1.1"
 
@@ -18,9 +23,31 @@ LEADERBOARD_PAGE = "/home1/c/cis520/html/fall11/leaderboard.html"
 MIN_TIME = 60*60*5 # once every 5 hours
 #MIN_TIME = 0
 
+PAGE_SIZE = 100 # teams per leaderboard page
+
 TEST_SET = 0
 QUIZ_SET = 1
 
+# Number of lines parsed and scored at a time, which bounds memory use for
+# very large answer sets.
+CHUNK_ROWS = 1 << 18
+
+LEADERBOARD_SCHEMA = """
+CREATE TABLE IF NOT EXISTS leaderboard (
+  name TEXT PRIMARY KEY,
+  submitted REAL NOT NULL,
+  test_accuracy REAL NOT NULL,
+  quiz_accuracy REAL NOT NULL,
+  test_rmse REAL NOT NULL,
+  quiz_rmse REAL NOT NULL,
+  best_rmse REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS leaderboard_best_rmse ON leaderboard (best_rmse, name);
+"""
+
+LEADERBOARD_COLUMNS = ("name, submitted, test_accuracy, quiz_accuracy, "
+                       "test_rmse, quiz_rmse, best_rmse")
+
 PAGE_TITLE_HTML =  """
   <h1>Leaderboard for CIS520 Final Project</h1>
   <h4>Updated: {updated}, version {version}</h4>
@@ -37,151 +64,7 @@ SUBMISSION_ROW_HTML = """
 </tr>
 """
 
-class LeaderBoard:
-    def __init__(self, dbfile):
-        self.dbfile = dbfile
-        if os.path.exists(dbfile):
-            self.db = pickle.load(file(dbfile, 'r'))
-        else:
-            self.db = {}
-
-    def get(self, name):
-        return self.db.get(name)
-
-    def update(self, name, submitted, accuracy, rmse):
-
-        if self.db.has_key(name):
-            old_rec = self.db[name]
-            old_rmse = old_rec['rmse']
-
-            # convert between old and new format
-            if len(old_rmse) == 2:
-                old_rmse.append(old_rmse[QUIZ_SET])
-
-            # keep the best RMSE so far
-            if rmse[QUIZ_SET] > old_rmse[2]:
-                rmse.append(old_rmse[2])
-            else:
-                rmse.append(rmse[QUIZ_SET])
-
-        else:
-            rmse.append(rmse[QUIZ_SET])
-
-        self.db[name] = {'name': name, 'submitted': submitted,
-                         'accuracy': accuracy, 'rmse': rmse}
-
-        pickle.dump(self.db, file(self.dbfile, 'w'))
-        
-class GroupLookup:
-    def __init__(self, dbfile):
-        self.db = pickle.load(file(dbfile, 'r'))
-    
-    def get(self, name):
-        return self.db['users'].get(name)
-    
-    def members(self, name):
-        return self.db['groups'].get(name)
-
-if __name__ == '__main__':
-    if len(sys.argv) == 1:
-        print "usage: %s <groups.db> <leaderboard.db> <answers.db> <path_to_submission>" % sys.argv[0]
-        sys.exit(1)
-
-    for i in [1, 3, 4]:
-        if not os.path.exists(sys.argv[i]):
-            sys.stderr.write( "error: %s does not exist\n" % sys.argv[i] )
-            sys.exit(1)
-
-    groups = GroupLookup(sys.argv[1])
-    leaderboard = LeaderBoard(sys.argv[2])
-
-    # Check for valid group
-    (submission_path, submission_ext) = os.path.splitext(sys.argv[4])
-
-    username = os.path.basename(submission_path)
-    groupname = groups.get(username)
-
-    if groupname is None:
-        sys.stderr.write("Error: username %s has no group\n"  % username)
-        sys.exit(1)
-
-    members = groups.members(groupname)
-    if len(members) > 3 or len(members) < 2:
-        sys.stderr.write("Error: team '%s' has %d members, which is not in the allowable range." % (groupname, len(members)))
-        sys.exit(1)
-
-    # Check that enough time has passed since the last submission
-    last_submission = leaderboard.get(groupname)
-    if last_submission is not None and (time.time()-last_submission['submitted']) < MIN_TIME:
-        sys.stderr.write("Error: it has only been %d seconds since your last submission. (Submissions allowed every %d seconds.)\n" 
-                         % (int(time.time()-last_submission['submitted']), MIN_TIME))
-        sys.exit(1)
-
-    # Read the submission
-    submission = None
-
-    # Untar first
-    tar = tarfile.open(name=sys.argv[4])
-    submission = tar.extractfile("submit.txt")
-    if submission is None:
-        sys.stderr.write( "Error: submission does not contain submit.txt!\n" )
-        sys.exit(1)
-
-    submit = submission.readlines()
-    answers = file(sys.argv[3], 'r').readlines()
-
-    # Compute accuracy and RMSE
-    if len(submit) != len(answers):
-        sys.stderr.write("Error: Submission must be %d lines, not %d.\n" % (len(answers), len(submit)))
-        sys.exit(1)
-
-    accuracy = [0, 0]
-    rmse = [0, 0]
-    n = [0, 0]
-    for i in range(0, len(answers)):
-        guess = submit[i].split()[0]
-        (truth, is_quiz) = answers[i].split()
-        
-        guess = float(guess)
-        truth = float(truth)
-        is_quiz = int(is_quiz)
-
-        n[is_quiz] += 1
-        accuracy[is_quiz] += float(round(guess) == round(truth))
-        rmse[is_quiz] += (guess-truth)**2
-
-    for i in range(0,len(n)):
-        accuracy[i] = accuracy[i] / float(n[i])
-        rmse[i] = math.sqrt(rmse[i]/float(n[i]))
-    
-    leaderboard.update(name=groupname, submitted=time.time(),
-                       accuracy=accuracy, rmse=rmse)
-
-    # Render the leaderboard
-    rows_html = ""
-
-    recs = leaderboard.db.values()
-    recs.sort(key= lambda x: float(x['rmse'][-1]), reverse=False) 
-
-    for rec in recs:
-        rows_html += SUBMISSION_ROW_HTML.format(
-            name=rec['name'], submitted=time.ctime(rec['submitted']),
-            accuracy=rec['accuracy'][QUIZ_SET], rmse=rec['rmse'][QUIZ_SET], 
-            best_rmse=rec['rmse'][-1])
-        rows_html += "\n"
-
-    rows_html += "</table>\n"
-
-    title_html = PAGE_TITLE_HTML.format(version=VERSION, 
-                                        updated=time.ctime())
-
-    print "*"*72
-    print "Your project results as of %s:" % time.ctime()
-    print "*"*72
-    print "Team: " + groupname
-    print "Accuracy: {0:.2%}, RMSE: {1:.2f}".format(accuracy[QUIZ_SET], rmse[QUIZ_SET])
-
-    HEADER_HTML = """
+HEADER_HTML = """
 <html>
 <head>
   <title>Project Leaderboard</title>
@@ -229,11 +112,11 @@ if __name__ == '__main__':
 </head>
 <body>
 """
-    FOOTER_HTML = """
+FOOTER_HTML = """
 </body>
 </html>
 """
-    SUBMISSION_TABLE_HTML = """
+SUBMISSION_TABLE_HTML = """
 <table class="sortable">
 <tr>
   <th>Group Name</th>
@@ -243,25 +126,475 @@ if __name__ == '__main__':
   <th>Best RMSE</th>
 </tr>
 """
-    leaderboard_html = file(LEADERBOARD_PAGE, 'w')
-    leaderboard_html.write(HEADER_HTML + title_html + SUBMISSION_TABLE_HTML
-                           + rows_html + FOOTER_HTML)
-    leaderboard_html.close()
 
+PAGE_NAV_HTML = """
+<p>{prev} Page {page} {next}</p>
+"""
 
-    
-    
+def PageFile(page_file, page):
+    """Returns the file name of the given 0-based leaderboard page."""
+    if page == 0:
+        return page_file
+    (base, ext) = os.path.splitext(page_file)
+    return "%s-%d%s" % (base, page + 1, ext)
+
+def RenderLeaderboard(leaderboard, page_file, changed=None):
+    """Writes the leaderboard as pages of PAGE_SIZE teams plus a JSON feed
+    of the top PAGE_SIZE teams next to page_file.
+
+    changed is the (first, last) range of 0-based ranks whose rows changed;
+    only the pages covering it are rewritten. None rewrites every page, as
+    does a change in the number of pages, which changes every page's
+    navigation. The feed is always rewritten.
+    """
+    num_teams = len(leaderboard)
+    num_pages = max(1, (num_teams + PAGE_SIZE - 1) // PAGE_SIZE)
+    if (changed is None or
+        not os.path.exists(PageFile(page_file, num_pages - 1)) or
+        os.path.exists(PageFile(page_file, num_pages))):
+        pages = range(num_pages)
+    else:
+        pages = range(changed[0] // PAGE_SIZE,
+                      min(changed[1] // PAGE_SIZE, num_pages - 1) + 1)
 
-        
-        
-        
+    title_html = PAGE_TITLE_HTML.format(version=VERSION, 
+                                        updated=time.ctime())
+    for page in pages:
+        recs = leaderboard.ranking(PAGE_SIZE, page * PAGE_SIZE)
+        html = [HEADER_HTML, title_html]
+        if num_pages > 1:
+            prev_html = next_html = ""
+            if page > 0:
+                prev_html = "<a href='%s'>&laquo; Previous</a>" % \
+                    os.path.basename(PageFile(page_file, page - 1))
+            if page < num_pages - 1:
+                next_html = "<a href='%s'>Next &raquo;</a>" % \
+                    os.path.basename(PageFile(page_file, page + 1))
+            html.append(PAGE_NAV_HTML.format(prev=prev_html, page=page + 1,
+                                             next=next_html))
+        html.append(SUBMISSION_TABLE_HTML)
+        for rec in recs:
+            html.append(SUBMISSION_ROW_HTML.format(
+                name=rec['name'], submitted=time.ctime(rec['submitted']),
+                accuracy=rec['accuracy'][QUIZ_SET], rmse=rec['rmse'][QUIZ_SET], 
+                best_rmse=rec['rmse'][-1]))
+            html.append("\n")
+        html.append("</table>\n")
+        html.append(FOOTER_HTML)
+        WriteFileAtomic(PageFile(page_file, page), ''.join(html))
+
+    # Pages left over from a longer leaderboard.
+    page = num_pages
+    while os.path.exists(PageFile(page_file, page)):
+        os.remove(PageFile(page_file, page))
+        page += 1
+
+    rows = [[rec['name'], int(rec['submitted']),
+             round(rec['accuracy'][QUIZ_SET], 4),
+             round(rec['rmse'][QUIZ_SET], 4), round(rec['rmse'][-1], 4)]
+            for rec in leaderboard.ranking(PAGE_SIZE)]
+    feed = {'updated': int(time.time()), 'teams': num_teams,
+            'columns': ['name', 'submitted', 'accuracy', 'rmse',
+                        'best_rmse'],
+            'rows': rows}
+    WriteFileAtomic(os.path.splitext(page_file)[0] + '.json',
+                    json.dumps(feed, separators=(',', ':')))
 
-    
-    
-    
-        
+class LeaderBoard:
+    """Leaderboard records stored in SQLite.
+
+    Each update is a single-row upsert inside an IMMEDIATE transaction, so
+    concurrent update_leaderboard.py runs are serialized instead of
+    overwriting each other. The ranking is read through an index on the
+    best RMSE. A leaderboard pickled by older versions is converted in place
+    the first time it is opened (the pickle is kept as <dbfile>.pickle).
+    """
+    def __init__(self, dbfile):
+        self.dbfile = dbfile
+        if os.path.exists(dbfile) and not IsSQLite(dbfile):
+            ConvertPickle(dbfile, LEADERBOARD_SCHEMA, self.LoadPickle)
+        self.conn = ConnectShared(dbfile, LEADERBOARD_SCHEMA)
 
+    def LoadPickle(self, conn, old_db):
+        for rec in old_db.values():
+            rmse = list(rec['rmse'])
+            # convert between old and new format
+            if len(rmse) == 2:
+                rmse.append(rmse[QUIZ_SET])
+            self.Write(conn, rec['name'], rec['submitted'],
+                       rec['accuracy'], rmse)
+
+    def Write(self, conn, name, submitted, accuracy, rmse):
+        conn.execute(
+            "INSERT OR REPLACE INTO leaderboard (name, submitted, "
+            "test_accuracy, quiz_accuracy, test_rmse, quiz_rmse, best_rmse) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (name, submitted, accuracy[TEST_SET], accuracy[QUIZ_SET],
+             rmse[TEST_SET], rmse[QUIZ_SET], rmse[2]))
+
+    def MakeRecord(self, row):
+        (name, submitted, test_accuracy, quiz_accuracy,
+         test_rmse, quiz_rmse, best_rmse) = row
+        return {'name': str(name), 'submitted': submitted,
+                'accuracy': [test_accuracy, quiz_accuracy],
+                'rmse': [test_rmse, quiz_rmse, best_rmse]}
+
+    def get(self, name):
+        row = self.conn.execute(
+            "SELECT " + LEADERBOARD_COLUMNS + " FROM leaderboard "
+            "WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            return None
+        return self.MakeRecord(row)
+
+    def update(self, name, submitted, accuracy, rmse):
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.conn.execute(
+                "SELECT best_rmse FROM leaderboard WHERE name = ?",
+                (name,)).fetchone()
+
+            # keep the best RMSE so far
+            if row is not None and rmse[QUIZ_SET] > row[0]:
+                rmse.append(row[0])
+            else:
+                rmse.append(rmse[QUIZ_SET])
+
+            self.Write(self.conn, name, submitted, accuracy, rmse)
+            self.conn.execute("COMMIT")
+        except:
+            self.conn.execute("ROLLBACK")
+            raise
+
+    def Rebuild(self, records):
+        """Replaces every record in one transaction. records are (name,
+        submitted, accuracy, rmse) with the best RMSE appended to rmse."""
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            self.conn.execute("DELETE FROM leaderboard")
+            for (name, submitted, accuracy, rmse) in records:
+                self.Write(self.conn, name, submitted, accuracy, rmse)
+            self.conn.execute("COMMIT")
+        except:
+            self.conn.execute("ROLLBACK")
+            raise
+
+    def ranking(self, limit=-1, offset=0):
+        """Returns records ordered by best RMSE, best first."""
+        return [self.MakeRecord(row) for row in self.conn.execute(
+                "SELECT " + LEADERBOARD_COLUMNS + " FROM leaderboard "
+                "ORDER BY best_rmse, name LIMIT ? OFFSET ?", (limit, offset))]
+
+    def rank(self, name):
+        """Returns the 0-based position of name in ranking(), or None."""
+        row = self.conn.execute(
+            "SELECT best_rmse FROM leaderboard WHERE name = ?",
+            (name,)).fetchone()
+        if row is None:
+            return None
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM leaderboard WHERE best_rmse < ? OR "
+            "(best_rmse = ? AND name < ?)", (row[0], row[0], name)).fetchone()[0]
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM leaderboard").fetchone()[0]
+
+def ParseColumn(lines, column, first_line=0):
+    """Parses the given whitespace separated column of lines as floats."""
+    try:
+        return np.array([line.split()[column] for line in lines],
+                        dtype=np.float64)
+    except IndexError:
+        for (i, line) in enumerate(lines):
+            if len(line.split()) <= column:
+                raise ValueError("Line %d has no column %d."
+                                 % (first_line + i + 1, column + 1))
+        raise
+
+def RoundHalfAway(x):
+    """Vectorized version of Python 2's round(), which rounds halves away
+    from zero (np.round rounds them to even)."""
+    return np.copysign(np.floor(np.abs(x) + 0.5), x)
+
+class Answers:
+    """The answers file compiled to NumPy arrays.
+
+    The text file is compiled once into <answers>.cache/ as .npy files of
+    the truth values, the rounded truth values and the quiz mask. Later runs
+    memory-map those files and reuse them until the answers file's size or
+    mtime changes.
+    """
+    FIELDS = ['truth', 'rounded', 'is_quiz']
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.cache_dir = filename + '.cache'
+        if not self.IsCurrent():
+            self.Compile()
+        self.Load()
+
+    def SourceStamp(self):
+        st = os.stat(self.filename)
+        return "%d %r" % (st.st_size, st.st_mtime)
+
+    def IsCurrent(self):
+        stamp_file = os.path.join(self.cache_dir, 'source')
+        if not os.path.exists(stamp_file):
+            return False
+        return file(stamp_file, 'r').read() == self.SourceStamp()
+
+    def Compile(self):
+        stamp = self.SourceStamp()
+        if not os.path.exists(self.cache_dir):
+            try:
+                os.mkdir(self.cache_dir)
+            except OSError:
+                pass # created by a concurrent run
+        stamp_file = os.path.join(self.cache_dir, 'source')
+        if os.path.exists(stamp_file):
+            os.remove(stamp_file)
+
+        num_lines = sum(1 for line in file(self.filename, 'r'))
+        tmp = {}
+        arrays = {}
+        for (field, dtype) in zip(self.FIELDS, [np.float64, np.float64, np.int8]):
+            tmp[field] = os.path.join(self.cache_dir, '%s.npy.tmp.%d' %
+                                      (field, os.getpid()))
+            arrays[field] = np.lib.format.open_memmap(
+                tmp[field], mode='w+', dtype=dtype, shape=(num_lines,))
+
+        fp = file(self.filename, 'r')
+        start = 0
+        while True:
+            lines = list(itertools.islice(fp, CHUNK_ROWS))
+            if len(lines) == 0:
+                break
+            end = start + len(lines)
+            truth = ParseColumn(lines, 0, start)
+            is_quiz = ParseColumn(lines, 1, start)
+            if np.any((is_quiz != TEST_SET) & (is_quiz != QUIZ_SET)):
+                raise ValueError("Answers must mark each line as test (%d) "
+                                 "or quiz (%d)." % (TEST_SET, QUIZ_SET))
+            arrays['truth'][start:end] = truth
+            arrays['rounded'][start:end] = RoundHalfAway(truth)
+            arrays['is_quiz'][start:end] = is_quiz
+            start = end
+        fp.close()
+
+        for field in self.FIELDS:
+            arrays[field].flush()
+            del arrays[field]
+            os.rename(tmp[field], os.path.join(self.cache_dir, field + '.npy'))
+
+        # Written last: marks the compiled arrays as matching the source.
+        tmp_stamp = stamp_file + '.tmp.%d' % os.getpid()
+        f = file(tmp_stamp, 'w')
+        f.write(stamp)
+        f.close()
+        os.rename(tmp_stamp, stamp_file)
+
+    def Load(self):
+        for field in self.FIELDS:
+            setattr(self, field, np.load(
+                    os.path.join(self.cache_dir, field + '.npy'), mmap_mode='r'))
+        self.num_lines = len(self.truth)
+        self.counts = np.bincount(self.is_quiz, minlength=2).astype(np.float64)
+
+    def Score(self, submission):
+        """Scores the lines of the file object submission. Returns lists of
+        [test, quiz] accuracy and RMSE."""
+        sq_error = np.zeros(2)
+        correct = np.zeros(2)
+        start = 0
+        while True:
+            lines = list(itertools.islice(submission, CHUNK_ROWS))
+            if len(lines) == 0:
+                break
+            end = start + len(lines)
+            if end > self.num_lines:
+                end += sum(1 for line in submission)
+                raise ValueError("Submission must be %d lines, not %d."
+                                 % (self.num_lines, end))
+
+            guess = ParseColumn(lines, 0, start)
+            is_quiz = self.is_quiz[start:end]
+            sq_error += np.bincount(is_quiz,
+                                    weights=(guess - self.truth[start:end])**2,
+                                    minlength=2)
+            correct += np.bincount(is_quiz,
+                                   weights=(RoundHalfAway(guess) ==
+                                            self.rounded[start:end]).astype(np.float64),
+                                   minlength=2)
+            start = end
+
+        if start != self.num_lines:
+            raise ValueError("Submission must be %d lines, not %d."
+                             % (self.num_lines, start))
+
+        accuracy = [float(x) for x in correct / self.counts]
+        rmse = [math.sqrt(x) for x in sq_error / self.counts]
+        return (accuracy, rmse)
+
+def CheckTeam(groups, username):
+    """Returns (team name, None) for a user in a team of allowed size, or
+    (None, error message)."""
+    groupname = groups.get(username)
+    if groupname is None:
+        return (None, "username %s has no group" % username)
+
+    members = groups.members(groupname)
+    if len(members) > 3 or len(members) < 2:
+        return (None, "team '%s' has %d members, which is not in the allowable range." % (groupname, len(members)))
+    return (groupname, None)
+
+# Answers of a rescoring pool worker, opened once per process.
+rescore_answers = None
+
+def RescoreInit(answers_file):
+    global rescore_answers
+    rescore_answers = Answers(answers_file)
+
+def RescoreSubmission(path):
+    """Scores one submission in a pool worker. Returns (path, (accuracy,
+    rmse)) or (path, error message)."""
+    try:
+        submission = OpenMember(path, "submit.txt")
+        if submission is None:
+            return (path, "submission does not contain submit.txt!")
+        return (path, rescore_answers.Score(submission))
+    except (tarfile.TarError, ArchiveError, ValueError, IOError) as err:
+        return (path, str(err))
+
+def Rescore(groups, leaderboard, answers_file, submission_dir, processes=None):
+    """Scores every submission in submission_dir against answers_file with
+    a pool of processes, then replaces the leaderboard with the results and
+    renders it once. Each team's entry is its most recent submission (by
+    mtime); its best RMSE is the best over its submissions. Returns the
+    number of teams."""
+    # Compile the answers cache once, before the workers map it.
+    Answers(answers_file)
+
+    paths = []
+    for filename in sorted(os.listdir(submission_dir)):
+        path = os.path.join(submission_dir, filename)
+        if filename.startswith('.') or not os.path.isfile(path):
+            continue
+        username = os.path.basename(os.path.splitext(path)[0])
+        (groupname, error) = CheckTeam(groups, username)
+        if groupname is None:
+            sys.stderr.write("Skipping %s: %s\n" % (filename, error))
+            continue
+        paths.append((path, groupname))
+
+    pool = multiprocessing.Pool(processes, RescoreInit, (answers_file,))
+    team_of = dict(paths)
+    teams = {}
+    chunksize = max(1, len(paths) // (4 * multiprocessing.cpu_count()))
+    for (path, result) in pool.imap_unordered(RescoreSubmission,
+                                              [p for (p, g) in paths], chunksize):
+        if isinstance(result, str):
+            sys.stderr.write("Skipping %s: %s\n" % (path, result))
+            continue
+        (accuracy, rmse) = result
+        groupname = team_of[path]
+        submitted = os.path.getmtime(path)
+        team = teams.get(groupname)
+        if team is None:
+            teams[groupname] = [submitted, accuracy, rmse, rmse[QUIZ_SET]]
+        else:
+            team[3] = min(team[3], rmse[QUIZ_SET])
+            if submitted > team[0]:
+                team[0:3] = [submitted, accuracy, rmse]
+    pool.close()
+    pool.join()
+
+    leaderboard.Rebuild([(name, submitted, accuracy, rmse + [best_rmse])
+                         for (name, (submitted, accuracy, rmse, best_rmse))
+                         in teams.iteritems()])
+    RenderLeaderboard(leaderboard, LEADERBOARD_PAGE)
+    return len(teams)
+
+if __name__ == '__main__':
+    if len(sys.argv) == 1:
+        print "usage: %s <groups.db> <leaderboard.db> <answers.db> <path_to_submission>" % sys.argv[0]
+        print "       %s --rescore <groups.db> <leaderboard.db> <answers.db> <submission_dir> [processes]" % sys.argv[0]
+        sys.exit(1)
+
+    if sys.argv[1] == '--rescore':
+        for i in [2, 4, 5]:
+            if not os.path.exists(sys.argv[i]):
+                sys.stderr.write( "error: %s does not exist\n" % sys.argv[i] )
+                sys.exit(1)
+        processes = None
+        if len(sys.argv) > 6:
+            processes = int(sys.argv[6])
+        start = time.time()
+        num_teams = Rescore(GroupStore(sys.argv[2]), LeaderBoard(sys.argv[3]),
+                            sys.argv[4], sys.argv[5], processes)
+        print "Rescored %d teams in %.1f secs" % (num_teams, time.time() - start)
+        sys.exit(0)
+
+    for i in [1, 3, 4]:
+        if not os.path.exists(sys.argv[i]):
+            sys.stderr.write( "error: %s does not exist\n" % sys.argv[i] )
+            sys.exit(1)
+
+    groups = GroupStore(sys.argv[1])
+    leaderboard = LeaderBoard(sys.argv[2])
+
+    # Check for valid group
+    (submission_path, submission_ext) = os.path.splitext(sys.argv[4])
+
+    username = os.path.basename(submission_path)
+    (groupname, error) = CheckTeam(groups, username)
+    if groupname is None:
+        sys.stderr.write("Error: %s\n" % error)
+        sys.exit(1)
+
+    # Check that enough time has passed since the last submission
+    last_submission = leaderboard.get(groupname)
+    if last_submission is not None and (time.time()-last_submission['submitted']) < MIN_TIME:
+        sys.stderr.write("Error: it has only been %d seconds since your last submission. (Submissions allowed every %d seconds.)\n" 
+                         % (int(time.time()-last_submission['submitted']), MIN_TIME))
+        sys.exit(1)
+
+    # Read the submission
+    submission = None
+
+    # Untar first
+    try:
+        submission = OpenMember(sys.argv[4], "submit.txt")
+    except (tarfile.TarError, ArchiveError) as err:
+        sys.stderr.write("Error: could not read submission: %s\n" % str(err))
+        sys.exit(1)
+    if submission is None:
+        sys.stderr.write( "Error: submission does not contain submit.txt!\n" )
+        sys.exit(1)
+
+    # Compute accuracy and RMSE
+    try:
+        (accuracy, rmse) = Answers(sys.argv[3]).Score(submission)
+    except ValueError as err:
+        sys.stderr.write("Error: %s\n" % str(err))
+        sys.exit(1)
     
-    
+    old_rank = leaderboard.rank(groupname)
+    leaderboard.update(name=groupname, submitted=time.time(),
+                       accuracy=accuracy, rmse=rmse)
+    new_rank = leaderboard.rank(groupname)
 
+    # Only rows between the team's old and new rank changed; a new team
+    # pushes every row below it down.
+    if old_rank is None:
+        changed = (new_rank, len(leaderboard) - 1)
+    else:
+        changed = (min(old_rank, new_rank), max(old_rank, new_rank))
+
+    # Render the leaderboard
+    RenderLeaderboard(leaderboard, LEADERBOARD_PAGE, changed)
 
+    print "*"*72
+    print "Your project results as of %s:" % time.ctime()
+    print "*"*72
+    print "Team: " + groupname
+    print "Accuracy: {0:.2%}, RMSE: {1:.2f}".format(accuracy[QUIZ_SET], rmse[QUIZ_SET])
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+#
+# Persistent grader processes for projects that set persistent_workers.
+#
+# Instead of starting the action once per submission, the monitor keeps
+# persistent_workers copies of it running, each started as
+#
+#   <action> --persistent <workspace>
+#
+# in its own session, with the project's memory and output limits and with
+# <workspace> as its working directory. Jobs are sent one per line of JSON
+# on the worker's stdin:
+#
+#   {"id": 7, "project": "p1", "filename": "user1", "workspace": "...",
+#    "stdout": "<log path>", "stderr": "<log path>"}
+#
+# The worker grades the submission, writes its output to the two log files
+# (created empty by the monitor) and answers with one line on its stdout:
+#
+#   {"id": 7, "returncode": 0}
+#
+# A remote submission staged by prefetch.py also has its local copy in
+# "path".
+#
+# Each job must be answered within the project's time_limit. A worker that
+# misses the deadline, exits, or answers out of turn is killed with its
+# whole process group and restarted, as is one that has done
+# persistent_jobs jobs. Workspaces (<workspace_dir>/<project>/<n>) belong
+# to a worker slot and are kept between its jobs; they are emptied only
+# when the slot's worker is restarted. A worker must exit when its stdin
+# is closed. Its own stderr goes to <log_dir>/<project>.worker<n>.log.
+
+import os, time, json, shutil, signal, subprocess, threading, resource
+import Queue
+
+class WorkerError(Exception):
+    pass
+
+def ProcUsage(pid):
+    """Returns (CPU secs of pid and its reaped children, peak RSS in KB),
+    or None where /proc is not available."""
+    try:
+        stat = file('/proc/%d/stat' % pid).read()
+        status = file('/proc/%d/status' % pid).read()
+    except IOError:
+        return None
+    # Fields after the parenthesized command name start at field 3.
+    fields = stat[stat.rindex(')') + 2:].split()
+    ticks = sum([int(x) for x in fields[11:15]])
+    max_rss = 0
+    for line in status.splitlines():
+        if line.startswith('VmHWM:'):
+            max_rss = int(line.split()[1])
+    return (float(ticks) / os.sysconf('SC_CLK_TCK'), max_rss)
+
+class WarmWorker:
+    """A worker slot: one persistent grader process and its workspace."""
+    def __init__(self, pool, index):
+        self.pool = pool
+        self.index = index
+        self.workspace = os.path.abspath(os.path.join(pool.workspace_dir,
+                                                      str(index)))
+        self.process = None
+        self.jobs = 0
+
+    def SetupChild(self):
+        # Runs in the child between fork and exec.
+        os.setsid()
+        for (rlimit, value) in self.pool.limits:
+            resource.setrlimit(rlimit, (value, value))
+
+    def Start(self):
+        if os.path.exists(self.workspace):
+            shutil.rmtree(self.workspace)
+        os.makedirs(self.workspace)
+        log = file(os.path.join(self.pool.log_dir, "%s.worker%d.log" % (
+                    self.pool.project, self.index)), 'a')
+        try:
+            self.process = subprocess.Popen(
+                [self.pool.executable, '--persistent', self.workspace],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=log,
+                cwd=self.workspace, preexec_fn=self.SetupChild, close_fds=True)
+        finally:
+            log.close()
+        self.jobs = 0
+        print "Started %s worker %d (pid %d)" % (self.pool.project, self.index,
+                                                 self.process.pid)
+
+    def KillGroup(self):
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except OSError:
+            pass # group already gone
+
+    def Stop(self):
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.close()
+        except IOError:
+            pass
+        self.KillGroup()
+        self.process.wait()
+        self.process.stdout.close()
+        self.process = None
+
+class WarmJob(threading.Thread):
+    """Runs one action on a worker of a pool. Has the same result fields as
+    ActionSlot and likewise puts itself on done_queue when finished."""
+    def __init__(self, pool, action, request, done_queue):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.pool = pool
+        self.action = action
+        self.request = request
+        self.done_queue = done_queue
+        self.worker = None
+        self.lock = threading.Lock()
+        self.answered = False
+        self.killed = False
+        self.returncode = None
+        self.error = None
+        self.start_time = None
+        self.elapsed = 0
+        self.cpu_time = None
+        self.max_rss = None
+
+    def Kill(self):
+        with self.lock:
+            if self.answered:
+                return
+            self.killed = True
+            print "Process is overtime after %.2f secs" % (
+                time.time() - self.start_time)
+            self.worker.KillGroup()
+
+    def Exchange(self):
+        """Sends the job and reads the answer. Returns True if the worker
+        can take another job."""
+        process = self.worker.process
+        self.request['workspace'] = self.worker.workspace
+        before = ProcUsage(process.pid)
+        process.stdin.write(json.dumps(self.request) + '\n')
+        process.stdin.flush()
+        line = process.stdout.readline()
+        if not line:
+            # Reap the worker, still under the deadline.
+            code = process.wait()
+            with self.lock:
+                self.answered = True
+            if self.killed:
+                return False
+            if code != 0:
+                self.returncode = code
+                return False
+            raise WorkerError("worker exited during the job")
+        with self.lock:
+            self.answered = True
+
+        after = ProcUsage(process.pid)
+        if before is not None and after is not None:
+            self.cpu_time = after[0] - before[0]
+            self.max_rss = after[1]
+        reply = json.loads(line)
+        if not isinstance(reply, dict):
+            raise WorkerError("worker answered %r instead of an object" % line)
+        if reply.get('id') != self.request['id']:
+            raise WorkerError("worker answered job %s instead of %s" % (
+                    reply.get('id'), self.request['id']))
+        self.returncode = int(reply['returncode'])
+        self.worker.jobs += 1
+        return self.worker.jobs < self.pool.max_jobs
+
+    def run(self):
+        staged = self.action.get('staged')
+        if staged is not None and staged.Wait() is not None:
+            self.request['path'] = os.path.abspath(staged.path)
+        self.worker = self.pool.Acquire()
+        self.start_time = time.time()
+        timer = None
+        reuse = False
+        try:
+            if self.worker.process is None:
+                self.worker.Start()
+            timer = threading.Timer(self.action['timeout'], self.Kill)
+            timer.daemon = True
+            timer.start()
+            reuse = self.Exchange()
+        except (IOError, OSError, ValueError, KeyError, TypeError,
+                WorkerError) as err:
+            self.error = err
+        finally:
+            if timer is not None:
+                timer.cancel()
+            with self.lock:
+                self.answered = True
+            self.elapsed = time.time() - self.start_time
+            self.done_queue.put(self)
+
+        # Replace the worker now so that its startup is out of the way by
+        # the time the next job arrives.
+        try:
+            if not reuse:
+                self.worker.Stop()
+                try:
+                    self.worker.Start()
+                except (IOError, OSError) as err:
+                    print "Unable to start %s worker %d: %s" % (
+                        self.pool.project, self.worker.index, str(err))
+                    self.worker.process = None
+        finally:
+            self.pool.Release(self.worker)
+
+class WarmPool:
+    """The persistent workers of one project."""
+    def __init__(self, project, executable, size, max_jobs, workspace_dir,
+                 log_dir, limits):
+        self.project = project
+        self.executable = executable
+        self.max_jobs = max_jobs
+        self.workspace_dir = os.path.join(workspace_dir, project)
+        self.log_dir = log_dir
+        self.limits = limits
+        self.workers = [WarmWorker(self, i) for i in range(size)]
+        self.idle = Queue.Queue()
+        for worker in self.workers:
+            self.idle.put(worker)
+
+    def StartWorkers(self):
+        for worker in self.workers:
+            if worker.process is None:
+                try:
+                    worker.Start()
+                except (IOError, OSError) as err:
+                    # Retried, and reported, by the first job on it.
+                    print "Unable to start %s worker %d: %s" % (
+                        self.project, worker.index, str(err))
+                    worker.process = None
+
+    def Acquire(self):
+        return self.idle.get()
+
+    def Release(self, worker):
+        self.idle.put(worker)
+
+    def Run(self, action, request, done_queue):
+        job = WarmJob(self, action, request, done_queue)
+        job.start()
+        return job
+
+    def Close(self):
+        # Waits for running jobs to hand their workers back.
+        for i in range(len(self.workers)):
+            self.Acquire().Stop()
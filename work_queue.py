@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+#
+# Lease-based work queue on shared storage, for grading on several hosts.
+#
+# The queue is a directory with three subdirectories:
+#
+#   pending/<id>.json           published by the monitor (the scanner)
+#   claimed/<id>@<worker>.json  claimed by a worker with an atomic rename
+#   done/<id>.json              the worker's result
+#
+# Renames within one filesystem are atomic (also on NFS), so exactly one
+# worker wins each claim. A worker renews its lease by touching the claimed
+# file; the scanner moves claims whose lease has expired back to pending/.
+# A worker that finds its claim gone has lost the lease and stops the job.
+
+import os, time, json, socket, threading
+
+class WorkQueue:
+    def __init__(self, queue_dir, lease_time):
+        self.queue_dir = queue_dir
+        self.lease_time = lease_time
+        self.pending_dir = os.path.join(queue_dir, 'pending')
+        self.claimed_dir = os.path.join(queue_dir, 'claimed')
+        self.done_dir = os.path.join(queue_dir, 'done')
+        for path in [self.pending_dir, self.claimed_dir, self.done_dir]:
+            if not os.path.exists(path):
+                try:
+                    os.makedirs(path)
+                except OSError:
+                    pass # created by another host
+
+    def WriteJSON(self, filename, data):
+        tmp_filename = os.path.join(self.queue_dir, '.%s.%s.%d' % (
+            os.path.basename(filename), socket.gethostname(), os.getpid()))
+        fp = file(tmp_filename, 'w')
+        json.dump(data, fp)
+        fp.close()
+        os.rename(tmp_filename, filename)
+
+    def ReadJSON(self, filename):
+        try:
+            return json.load(file(filename, 'r'))
+        except (IOError, ValueError):
+            return None
+
+    # Scanner side.
+
+    def Publish(self, job):
+        """Adds job (a dict with a unique 'id') to pending/."""
+        self.WriteJSON(os.path.join(self.pending_dir, job['id'] + '.json'), job)
+
+    def Collect(self):
+        """Removes and returns the results workers have reported."""
+        results = []
+        for filename in sorted(os.listdir(self.done_dir)):
+            path = os.path.join(self.done_dir, filename)
+            result = self.ReadJSON(path)
+            os.remove(path)
+            if result is not None:
+                results.append(result)
+        return results
+
+    def RequeueExpired(self):
+        """Moves claims whose lease has expired back to pending/. Returns
+        the ids of the requeued jobs."""
+        requeued = []
+        now = time.time()
+        for filename in os.listdir(self.claimed_dir):
+            path = os.path.join(self.claimed_dir, filename)
+            try:
+                if now - os.stat(path).st_mtime < self.lease_time:
+                    continue
+                job_id = filename.split('@')[0]
+                os.rename(path, os.path.join(self.pending_dir, job_id + '.json'))
+                requeued.append(job_id)
+            except OSError:
+                pass # completed or renewed meanwhile
+        return requeued
+
+    def Cancel(self, job_id):
+        """Drops any pending or claimed copy of a job."""
+        for path in [os.path.join(self.pending_dir, job_id + '.json')] + \
+                [os.path.join(self.claimed_dir, f)
+                 for f in os.listdir(self.claimed_dir)
+                 if f.split('@')[0] == job_id]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def Purge(self):
+        """Drops the jobs and results of an earlier run of the scanner,
+        whose submissions the monitor's database recovery queues again.
+        A worker still running one of the claimed jobs loses its lease and
+        stops it."""
+        for dirname in [self.pending_dir, self.claimed_dir, self.done_dir]:
+            for filename in os.listdir(dirname):
+                try:
+                    os.remove(os.path.join(dirname, filename))
+                except OSError:
+                    pass
+
+    # Worker side.
+
+    def Claim(self, worker_id):
+        """Claims the oldest pending job. Returns (job, lease path) or
+        (None, None) if there is nothing to do."""
+        for filename in sorted(os.listdir(self.pending_dir)):
+            if not filename.endswith('.json'):
+                continue
+            job_id = filename[:-len('.json')]
+            lease = os.path.join(self.claimed_dir,
+                                 '%s@%s.json' % (job_id, worker_id))
+            try:
+                os.rename(os.path.join(self.pending_dir, filename), lease)
+            except OSError:
+                continue # claimed by someone else
+            os.utime(lease, None)
+            job = self.ReadJSON(lease)
+            if job is not None:
+                return (job, lease)
+        return (None, None)
+
+    def Renew(self, lease):
+        """Extends a lease. Returns False if it has been lost."""
+        try:
+            os.utime(lease, None)
+            return True
+        except OSError:
+            return False
+
+    def Complete(self, job, lease, result):
+        result['id'] = job['id']
+        self.WriteJSON(os.path.join(self.done_dir, job['id'] + '.json'), result)
+        try:
+            os.remove(lease)
+        except OSError:
+            pass
+
+class RemoteJob:
+    """Stands in for an ActionSlot while an action runs on a worker; once
+    the worker reports back it carries the same result fields."""
+    def __init__(self, action, job_id):
+        self.action = action
+        self.job_id = job_id
+        self.killed = False
+        self.returncode = None
+        self.error = None
+        self.elapsed = 0
+        self.cpu_time = None
+        self.max_rss = None
+
+    def SetResult(self, result):
+        self.killed = result['killed']
+        self.returncode = result['returncode']
+        self.error = result['error']
+        self.elapsed = result['elapsed']
+        self.cpu_time = result['cpu_time']
+        self.max_rss = result['max_rss']
+
+class QueueCollector(threading.Thread):
+    """Scanner-side thread that requeues expired leases and puts each
+    finished RemoteJob on the monitor's done queue."""
+    def __init__(self, work_queue, done_queue, interval):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.work_queue = work_queue
+        self.done_queue = done_queue
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.jobs = {}
+
+    def Add(self, job):
+        with self.lock:
+            self.jobs[job.job_id] = job
+
+    def run(self):
+        while True:
+            for job_id in self.work_queue.RequeueExpired():
+                print "Lease expired, requeued job %s" % job_id
+            for result in self.work_queue.Collect():
+                with self.lock:
+                    job = self.jobs.pop(result['id'], None)
+                if job is None:
+                    continue # a duplicate result after a requeue
+                # Another worker may hold a requeued copy of this job.
+                self.work_queue.Cancel(result['id'])
+                job.SetResult(result)
+                self.done_queue.put(job)
+            time.sleep(self.interval)